@@ -63,4 +63,12 @@ setup(
         'pyusb',
         'msgpack-python'
     ],
+    extras_require={
+        'export': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': [
+            'ant-log = ant.core.logtool:main',
+        ],
+    },
 )
@@ -34,11 +34,13 @@ MESSAGE_CHANNEL_ASSIGN = 0x42
 MESSAGE_CHANNEL_ID = 0x51
 MESSAGE_CHANNEL_PERIOD = 0x43
 MESSAGE_CHANNEL_SEARCH_TIMEOUT = 0x44
+MESSAGE_CHANNEL_LOW_PRIORITY_SEARCH_TIMEOUT = 0x63
 MESSAGE_CHANNEL_FREQUENCY = 0x45
 MESSAGE_CHANNEL_TX_POWER = 0x60
 MESSAGE_NETWORK_KEY = 0x46
 MESSAGE_TX_POWER = 0x47
 MESSAGE_PROXIMITY_SEARCH = 0x71
+MESSAGE_LIB_CONFIG = 0x6E
 
 # Notification messages
 MESSAGE_STARTUP = 0x6F
@@ -48,6 +50,7 @@ MESSAGE_SYSTEM_RESET = 0x4A
 MESSAGE_CHANNEL_OPEN = 0x4B
 MESSAGE_CHANNEL_CLOSE = 0x4C
 MESSAGE_CHANNEL_REQUEST = 0x4D
+MESSAGE_OPEN_RX_SCAN_MODE = 0x5B
 
 # Data messages
 MESSAGE_CHANNEL_BROADCAST_DATA = 0x4E
@@ -75,6 +78,9 @@ RADIO_TX_POWER_MINUS20DB = 0x00
 RADIO_TX_POWER_MINUS10DB = 0x01
 RADIO_TX_POWER_0DB = 0x02
 RADIO_TX_POWER_PLUS4DB = 0x03
+LIB_CONFIG_CHANNEL_ID = 0x80  # also the extended data flag byte bits
+LIB_CONFIG_RSSI = 0x40
+LIB_CONFIG_RX_TIMESTAMP = 0x20
 
 # Message Codes
 RESPONSE_NO_ERROR = 0x00
@@ -26,10 +26,11 @@
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+from binascii import hexlify
 from threading import Lock
 
 # USB1 driver uses a USB<->Serial bridge
-from serial import Serial, SerialException, SerialTimeoutException
+from serial import Serial, SerialException
 # USB2 driver uses direct USB connection. Requires PyUSB
 from usb.control import get_interface
 from usb.core import USBError, find as findDeviceUSB
@@ -60,6 +61,20 @@ class Driver(object):
         with self._lock:
             return self._opened
     
+    def reopen(self):
+        # open again after the device was lost, closing it first as far as
+        # that is still possible
+        with self._lock:
+            if self._opened:
+                try:
+                    self._close()
+                except Exception:  # pylint: disable=broad-except
+                    pass
+            
+            self._open()
+            if self.log:
+                self.log.logOpen()
+    
     def close(self):
         with self._lock:
             if not self._opened:
@@ -77,10 +92,13 @@ class Driver(object):
         
         data = self._read(count)
         
-        with self._lock:
-            if self.log:
-                self.log.logRead(data)
-            if self.debug:
+        # logging is kept out of the lock, log writers are expected to
+        # hand the data off without blocking on disk I/O
+        log = self.log
+        if log:
+            log.logRead(data)
+        if self.debug:
+            with self._lock:
                 self._dump(data, 'READ')
         return data
     
@@ -90,13 +108,15 @@ class Driver(object):
         if not self.opened:
             raise DriverError("Could not write to device (not open).")
         
-        ret = self._write(data.encode())
+        raw = data.encode()
+        ret = self._write(raw)
         
-        with self._lock:
-            if self.debug:
-                self._dump(data, 'WRITE')
-            if self.log:
-                self.log.logWrite(data[0:ret])
+        if self.debug:
+            with self._lock:
+                self._dump(raw, 'WRITE')
+        log = self.log
+        if log:
+            log.logWrite(raw[0:ret])
         return ret
     
     @staticmethod
@@ -107,12 +127,9 @@ class Driver(object):
         print("========== [{0}] ==========".format(title))
         
         length = 8
-        line = 0
-        while data:
-            row = data[:length]
-            data = data[length:]
-            hex_data = [b'%02X' % ord(byte) for byte in row]
-            print(b'%04X' % line, b' '.join(hex_data))
+        for line in range(0, len(data), length):
+            row = hexlify(bytes(data[line:line + length])).decode('ascii').upper()
+            print('%04X' % line, ' '.join(row[i:i + 2] for i in range(0, len(row), 2)))
         
         print()
     
@@ -160,13 +177,18 @@ class USB1Driver(Driver):
         self._serial.close()
     
     def _read(self, count):
-        return self._serial.read(count)
+        # an unplugged stick raises SerialException, a DriverError lets the
+        # event pump recover from it
+        try:
+            return self._serial.read(count)
+        except SerialException as e:
+            raise DriverError(str(e))
     
     def _write(self, data):
         try:
             count = self._serial.write(data)
             self._serial.flush()
-        except SerialTimeoutException as e:
+        except SerialException as e:
             raise DriverError(str(e))
         
         return count
@@ -30,12 +30,17 @@
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+from collections import namedtuple
 from time import sleep, time
-from threading import Lock, Thread
+from threading import Condition, Event, Lock, Thread, current_thread
 
-from ant.core.constants import MESSAGE_TX_SYNC, RESPONSE_NO_ERROR
-from ant.core.message import Message, ChannelEventResponseMessage
-from ant.core.exceptions import MessageError
+from ant.core.constants import (MESSAGE_TX_SYNC, RESPONSE_NO_ERROR,
+                                MESSAGE_CHANNEL_BROADCAST_DATA,
+                                MESSAGE_CHANNEL_ACKNOWLEDGED_DATA,
+                                MESSAGE_CHANNEL_BURST_DATA, EVENT_SERIAL_QUE_OVERFLOW,
+                                EVENT_QUEUE_OVERFLOW)
+from ant.core.message import Message, ChannelMessage, ChannelEventResponseMessage
+from ant.core.exceptions import DriverError, MessageError
 from usb.core import USBError
 
 
@@ -48,8 +53,11 @@ def EventPump(evm):
         
         try:
             buffer_ += evm.driver.read(20)
-        except USBError as e:
-            if e.errno == 110:  # timeout
+        except (USBError, DriverError) as e:
+            if getattr(e, 'errno', None) == 110:  # timeout
+                continue
+            elif evm.recover(e):
+                buffer_ = b''  # reopened, drop what was half read
                 continue
             else:
                 raise
@@ -70,6 +78,11 @@ def EventPump(evm):
                 else:
                     break
         
+        capture = evm.capture
+        if capture is not None:
+            for message in messages:
+                capture.logMessageRead(message)
+        
         with evm.evmCallbackLock:
             for message in messages:
                 for callback in evm.callbacks:
@@ -79,6 +92,15 @@ def EventPump(evm):
                         print(err)
 
 
+class ConnectionEvent(namedtuple('ConnectionEvent', 'state error elapsed')):
+    # Handed to the event machine's callbacks, alongside messages, as the
+    # device is lost and recovered: `error` is what was raised, `elapsed`
+    # the seconds since the device was lost.
+    LOST = 'lost'
+    RECOVERED = 'recovered'
+    FAILED = 'failed'
+
+
 class EventCallback(object):
     def process(self, msg):
         raise NotImplementedError()
@@ -101,10 +123,11 @@ class EventMachineCallback(EventCallback):
                 self.messages = messages[-MAX_QUEUE:]
     
     def waitFor(self, foo, timeout=10):  # pylint: disable=blacklisted-name
-        messages = self.messages
         basetime = time()
         while time() - basetime < timeout:
             with self.lock:
+                # process() replaces the list when trimming it
+                messages = self.messages
                 for emsg in messages:
                     if self.WAIT_UNTIL(foo, emsg):
                         messages.remove(emsg)
@@ -113,7 +136,11 @@ class EventMachineCallback(EventCallback):
         raise MessageError("%s: timeout" % str(foo), internal=foo)
 
 class AckCallback(EventMachineCallback):
-    WAIT_UNTIL = staticmethod(lambda msg, emsg: msg.type == emsg.messageID)
+    # responses to channel commands must be for the same channel, so channels
+    # sending the same command at once get their own response
+    WAIT_UNTIL = staticmethod(lambda msg, emsg: msg.type == emsg.messageID and
+                              (not isinstance(msg, ChannelMessage) or
+                               msg.channelNumber == emsg.channelNumber))
     
     def process(self, msg):
         if isinstance(msg, ChannelEventResponseMessage) and \
@@ -125,9 +152,254 @@ class MsgCallback(EventMachineCallback):
     WAIT_UNTIL = staticmethod(lambda class_, emsg: isinstance(emsg, class_))
 
 
+class Future(object):
+    # The outcome of something completed by the event pump. result() and
+    # exception() block until it is set (or `timeout` seconds pass), done
+    # callbacks run in the thread setting it, or right away if already done.
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+    
+    def done(self):
+        return self._event.is_set()
+    
+    def _wait(self, timeout):
+        if not self._event.wait(timeout):
+            raise MessageError('future: timeout')
+    
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception  # pylint: disable=raising-bad-type
+        return self._result
+    
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+    
+    def addDoneCallback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+    
+    def _set(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._result, self._exception = result, exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as err:  # pylint: disable=broad-except
+                print(err)
+    
+    def setResult(self, result):
+        self._set(result, None)
+    
+    def setException(self, exception):
+        self._set(None, exception)
+
+
+class TransferFuture(Future):
+    # a Future for a transfer of `total` packets, `sent` of them written
+    def __init__(self, total):
+        super(TransferFuture, self).__init__()
+        self.total = total
+        self.sent = 0
+    
+    @property
+    def progress(self):
+        return self.sent / self.total if self.total else 1.0
+
+
+class MessageBatch(object):
+    # Messages encoded once and written to the driver in one go
+    def __init__(self, messages):
+        self.messages = messages
+        self._raw = bytearray()
+        for msg in messages:
+            self._raw += msg.encode()
+    
+    def encode(self):
+        return self._raw
+    
+    def __len__(self):
+        return len(self._raw)
+
+
+class MessageFrame(object):
+    # A channel data message encoded once. update() rewrites its 8 data bytes
+    # and the checksum in place, so the frame is written again and again
+    # without allocating.
+    def __init__(self, msg):
+        raw = self._raw = msg.encode()
+        if len(raw) != 13:
+            raise MessageError('Could not frame message (not 8 data bytes).')
+        checksum = 0
+        for byte in raw[:4]:
+            checksum ^= byte
+        self._header = checksum
+    
+    def update(self, data):
+        if len(data) != 8:
+            raise MessageError('Could not update frame (expected 8 data bytes).')
+        raw = self._raw
+        raw[4:12] = data
+        checksum = self._header
+        for i in range(4, 12):
+            checksum ^= raw[i]
+        raw[12] = checksum
+    
+    @property
+    def messages(self):
+        # for the capture log
+        return (Message.decode(self._raw),)
+    
+    def encode(self):
+        return self._raw
+    
+    def __len__(self):
+        return 13
+
+
+class ChannelEventWaiter(object):
+    def __init__(self, key):
+        self.key = key
+        self.event = Event()
+        self.msg = None
+
+
+class ChannelEventCallback(EventCallback):
+    # Channel events waited for by (channel, code). Each waiter has its own
+    # threading.Event, so waiting neither polls nor takes events meant for
+    # someone else. Waiters are set up with expect() before the command that
+    # causes the event is sent, so the event cannot slip by.
+    def __init__(self):
+        self.waiters = {}
+        self.lock = Lock()
+    
+    def process(self, msg):
+        if not isinstance(msg, ChannelEventResponseMessage) or msg.messageID != 1:
+            return
+        with self.lock:
+            waiters = self.waiters.pop((msg.channelNumber, msg.messageCode), ())
+        for waiter in waiters:
+            waiter.msg = msg
+            waiter.event.set()
+    
+    def expect(self, channel, code):
+        waiter = ChannelEventWaiter((channel, code))
+        with self.lock:
+            self.waiters.setdefault(waiter.key, []).append(waiter)
+        return waiter
+    
+    def cancel(self, waiter):
+        with self.lock:
+            waiters = self.waiters.get(waiter.key, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[waiter.key]
+    
+    def waitFor(self, waiter, timeout=10):
+        if not waiter.event.wait(timeout):
+            self.cancel(waiter)
+            raise MessageError("channel %d event 0x%.2x: timeout" % waiter.key,
+                               internal=waiter.key)
+        return waiter.msg
+
+
+class OutboundScheduler(EventCallback):
+    # Paces writes to what the stick can buffer. Each message written takes
+    # a credit; there are at most `credits` (the stick's buffer) and they
+    # come back at `rate` per second, as the stick works through them.
+    # Writers wait for credits in priority order, so control commands go
+    # ahead of waiting data. An overflow event reported by the stick drops
+    # the credits left and halves the rate (down to `minRate`), which then
+    # recovers by RECOVERY messages per second each second.
+    CONTROL, DATA = 0, 1
+    CREDITS = 16
+    RATE = 500.0
+    MIN_RATE = 20.0
+    RECOVERY = 50.0
+    DATA_TYPES = frozenset((MESSAGE_CHANNEL_BROADCAST_DATA,
+                            MESSAGE_CHANNEL_ACKNOWLEDGED_DATA, MESSAGE_CHANNEL_BURST_DATA))
+    
+    def __init__(self, credits=CREDITS, rate=RATE, minRate=MIN_RATE):
+        self.credits = credits
+        self.maxRate = self.rate = rate
+        self.minRate = minRate
+        self.overflows = 0
+        self._available = credits
+        self._stamp = time()
+        self._waiting = [0, 0]  # writers waiting, by priority
+        self._condition = Condition(Lock())
+    
+    def priority(self, msg):
+        # a batch is data only if all it holds is
+        if isinstance(msg, MessageBatch):
+            data = all(inner.type in self.DATA_TYPES for inner in msg.messages)
+        else:
+            data = isinstance(msg, MessageFrame) or \
+                   getattr(msg, 'type', None) in self.DATA_TYPES
+        return self.DATA if data else self.CONTROL
+    
+    def _refill(self):
+        now = time()
+        elapsed, self._stamp = now - self._stamp, now
+        self._available = min(self.credits, self._available + elapsed * self.rate)
+        if self.rate < self.maxRate:
+            self.rate = min(self.maxRate, self.rate + elapsed * self.RECOVERY)
+    
+    def acquire(self, priority, count=1, wait=True):
+        # Block until `count` messages (at most a buffer full) may be written.
+        # Without `wait` the credits are taken right away, going into debt
+        # that later writers wait off: the event pump must not stop reading.
+        count = min(count, self.credits)
+        waiting = self._waiting
+        if not wait:
+            with self._condition:
+                self._refill()
+                self._available -= count
+            return
+        with self._condition:
+            waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    ahead = any(waiting[:priority])
+                    if not ahead and self._available >= count:
+                        self._available -= count
+                        return
+                    missing = max(count - self._available, 1)
+                    self._condition.wait(missing / self.rate)
+            finally:
+                waiting[priority] -= 1
+                self._condition.notify_all()
+    
+    def process(self, msg):
+        if isinstance(msg, ChannelEventResponseMessage) and msg.messageID == 1 and \
+           msg.messageCode in (EVENT_SERIAL_QUE_OVERFLOW, EVENT_QUEUE_OVERFLOW):
+            with self._condition:
+                self._refill()
+                self.overflows += 1
+                self._available = 0
+                self.rate = max(self.minRate, self.rate / 2)
+
+
 class EventMachine(object):
-    def __init__(self, driver):
+    def __init__(self, driver, capture=None, scheduler=None):
         self.driver = driver
+        # a LogWriter recording decoded messages, an alternative to the
+        # driver's log of raw reads and writes that needs no framing later
+        self.capture = capture
         self.callbacks = set()
         self.eventPump = None
         self.running = False
@@ -137,8 +409,16 @@ class EventMachine(object):
         
         self.ack = ack = AckCallback()
         self.msg = msg = MsgCallback()
+        self.events = events = ChannelEventCallback()
+        self.scheduler = scheduler = scheduler if scheduler is not None \
+                                     else OutboundScheduler()
+        # called by the pump with a device error, returns whether the driver
+        # could be reopened, see node.Reconnector
+        self.recovery = None
         self.registerCallback(ack)
         self.registerCallback(msg)
+        self.registerCallback(events)
+        self.registerCallback(scheduler)
     
     def registerCallback(self, callback):
         with self.evmCallbackLock:
@@ -151,10 +431,35 @@ class EventMachine(object):
             except KeyError:
                 pass
     
-    def writeMessage(self, msg):
+    def writeMessage(self, msg, priority=None):
+        # `msg` may be a MessageBatch or a MessageFrame. Writes wait for the
+        # scheduler, by default control commands ahead of data, except those
+        # made from callbacks on the event pump.
+        scheduler = self.scheduler
+        if priority is None:
+            priority = scheduler.priority(msg)
+        scheduler.acquire(priority, len(msg.messages) if isinstance(msg, MessageBatch)
+                          else 1, wait=current_thread() is not self.eventPump)
         self.driver.write(msg)
+        capture = self.capture
+        if capture is not None:
+            for written in getattr(msg, 'messages', (msg,)):
+                capture.logMessageWrite(written)
         return self
     
+    def recover(self, err):
+        recovery = self.recovery
+        return recovery is not None and recovery(err)
+    
+    def notify(self, msg):
+        # hand `msg` to the callbacks, as the pump does with what it reads
+        with self.evmCallbackLock:
+            for callback in self.callbacks:
+                try:
+                    callback.process(msg)
+                except Exception as err:  # pylint: disable=broad-except
+                    print(err)
+    
     def waitForAck(self, msg):
         response = self.ack.waitFor(msg).messageCode
         if response != RESPONSE_NO_ERROR:
@@ -164,6 +469,12 @@ class EventMachine(object):
     def waitForMessage(self, class_):
         return self.msg.waitFor(class_)
     
+    def expectEvent(self, channel, code):
+        return self.events.expect(channel, code)
+    
+    def waitForEvent(self, waiter, timeout=10):
+        return self.events.waitFor(waiter, timeout)
+    
     def start(self, driver=None):
         with self.runningLock:
             if self.running:
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring, invalid-name
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+from bisect import bisect_left, bisect_right
+
+import numpy
+
+from ant.core.constants import MESSAGE_TX_SYNC
+from ant.core.log import (LogReader, CHANNEL_MESSAGES, EVENT_READ,
+                          EVENT_WRITE, MESSAGE_EVENTS)
+
+COLUMNS = ('timestamp', 'direction', 'type', 'channel', 'data', 'valid')
+CHUNK_SIZE = 4 * 1024 * 1024
+
+_CHANNEL_MESSAGES = numpy.array(sorted(CHANNEL_MESSAGES), dtype=numpy.uint8)
+_DATA = numpy.arange(8)
+
+
+def _frame(raw, starts, stamps, direction, final=False):
+    # Frame a chunk of raw bytes from one direction. `starts` and `stamps`
+    # hold the offset and timestamp of each record the bytes came from.
+    # Returns the columns and the offset of the trailing incomplete frame.
+    # With `final` no more bytes will come: a sync byte whose frame would
+    # run past the end is noise, and scanning goes on after it.
+    length = len(raw)
+    buf = numpy.frombuffer(bytes(raw) + b'\x00' * 16, dtype=numpy.uint8)
+    syncs = numpy.flatnonzero(buf[:length] == MESSAGE_TX_SYNC)
+    ends = syncs + buf[syncs + 1].astype(numpy.int64) + 4
+    
+    # a frame XORs to zero, checksum byte included
+    xors = numpy.zeros(len(buf) + 1, dtype=numpy.uint8)
+    numpy.bitwise_xor.accumulate(buf, out=xors[1:])
+    valid = (xors[numpy.minimum(ends, len(buf))] ^ xors[syncs]) == 0
+    
+    # Choosing frames is inherently sequential, but only takes a step per
+    # frame: a good frame skips to its end, a bad one to the next sync byte.
+    positions, endList, validList = syncs.tolist(), ends.tolist(), valid.tolist()
+    taken, tail = [], length
+    i, count = 0, len(positions)
+    while i < count:
+        if endList[i] > length:
+            if final:
+                i += 1
+                continue
+            tail = positions[i]
+            break
+        taken.append(i)
+        if validList[i]:
+            i = bisect_left(positions, endList[i], i + 1)
+        else:
+            i += 1
+    
+    taken = numpy.array(taken, dtype=numpy.int64)
+    syncs, ends, valid = syncs[taken], ends[taken], valid[taken]
+    types = buf[syncs + 2]
+    isChannel = numpy.in1d(types, _CHANNEL_MESSAGES) & (buf[syncs + 1] > 0)
+    channels = numpy.where(isChannel, buf[syncs + 3], -1).astype(numpy.int16)
+    
+    # up to 8 payload bytes, following the channel number if there is one
+    first = syncs + 3 + isChannel
+    size = ends - 1 - first
+    data = buf[first[:, None] + _DATA]
+    data[_DATA >= size[:, None]] = 0
+    
+    records = numpy.searchsorted(starts, ends - 1, side='right') - 1
+    columns = {
+        'timestamp': stamps[records],
+        'direction': numpy.full(len(syncs), direction, dtype=numpy.uint8),
+        'type': types,
+        'channel': channels,
+        'data': data,
+        'valid': valid,
+    }
+    return columns, tail
+
+
+def _messages(events, scale):
+    # columns for captured messages, which need no framing
+    count = len(events)
+    data = numpy.zeros((count, 8), dtype=numpy.uint8)
+    for row, event in enumerate(events):
+        payload = bytearray(event[4])[0 if event[3] is None else 1:][:8]
+        data[row, :len(payload)] = list(payload)
+    
+    return {
+        'timestamp': numpy.array([event[1] for event in events],
+                                 dtype=numpy.int64) * scale,
+        'direction': numpy.array([MESSAGE_EVENTS[event[0]] for event in events],
+                                 dtype=numpy.uint8),
+        'type': numpy.array([event[2] for event in events], dtype=numpy.uint8),
+        'channel': numpy.array([-1 if event[3] is None else event[3]
+                                for event in events], dtype=numpy.int16),
+        'data': data,
+        'valid': numpy.ones(count, dtype=bool),
+    }
+
+
+def toArrays(filename, start=None, end=None, chunkSize=CHUNK_SIZE):
+    # Turn a capture into columns of NumPy arrays, one row per frame:
+    # `timestamp` (int64 nanoseconds, when the frame was complete),
+    # `direction` (EVENT_READ or EVENT_WRITE), `type`, `channel` (-1 for
+    # non-channel messages), `data` (an (N, 8) uint8 matrix, zero padded) and
+    # `valid` (whether the checksum matched). Rows are in timestamp order.
+    # Captured messages (see EventMachine.capture) become rows as they are.
+    log = LogReader(filename)
+    scale = 1000000000 // log.timescale
+    events = log.iter(start=start, end=end)
+    
+    pending = dict((direction, (bytearray(), [], [])) for direction in
+                   (EVENT_READ, EVENT_WRITE))
+    parts, messages = [], []
+    
+    def flush(direction, final=False):
+        raw, starts, stamps = pending[direction]
+        columns, tail = _frame(raw, numpy.array(starts, dtype=numpy.int64),
+                               numpy.array(stamps, dtype=numpy.int64), direction,
+                               final)
+        parts.append(columns)
+        if tail < len(raw):
+            # the incomplete frame carries over as a record of its own
+            record = bisect_right(starts, tail) - 1
+            pending[direction] = (raw[tail:], [0], [stamps[record]])
+        else:
+            pending[direction] = (bytearray(), [], [])
+    
+    for event in events:
+        direction = event[0]
+        if direction in MESSAGE_EVENTS:
+            messages.append(event)
+            if len(messages) >= chunkSize // 16:
+                parts.append(_messages(messages, scale))
+                messages = []
+            continue
+        if direction not in pending or len(event) < 3:
+            continue
+        raw, starts, stamps = pending[direction]
+        starts.append(len(raw))
+        stamps.append(event[1] * scale)
+        raw += event[2]
+        if len(raw) >= chunkSize:
+            flush(direction)
+    for direction in pending:
+        if pending[direction][0]:
+            flush(direction, final=True)
+    if messages:
+        parts.append(_messages(messages, scale))
+    log.close()
+    
+    if not parts:
+        return {
+            'timestamp': numpy.zeros(0, dtype=numpy.int64),
+            'direction': numpy.zeros(0, dtype=numpy.uint8),
+            'type': numpy.zeros(0, dtype=numpy.uint8),
+            'channel': numpy.zeros(0, dtype=numpy.int16),
+            'data': numpy.zeros((0, 8), dtype=numpy.uint8),
+            'valid': numpy.zeros(0, dtype=bool),
+        }
+    
+    arrays = dict((name, numpy.concatenate([part[name] for part in parts]))
+                  for name in COLUMNS)
+    order = numpy.argsort(arrays['timestamp'], kind='mergesort')
+    return dict((name, column[order]) for name, column in arrays.items())
+
+
+def saveArrays(filename, output, **kwargs):
+    # Export a capture to an uncompressed .npz archive, see toArrays()
+    arrays = toArrays(filename, **kwargs)
+    numpy.savez(output, **arrays)
+    return arrays
@@ -26,58 +26,674 @@
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+from bisect import bisect_left, bisect_right
+from collections import deque
+from heapq import heapify, heappop, heapreplace
+from functools import reduce
+from itertools import islice
+from multiprocessing import Pool
+from operator import xor
+from mmap import mmap, ACCESS_READ
+from os import remove
+from os.path import exists, splitext
+from struct import Struct, error as StructError
 from time import time
+from threading import Lock, Thread
 import datetime
+import zlib
+
+try:
+    from queue import Queue, Full, Empty
+except ImportError:
+    from Queue import Queue, Full, Empty
+
+try:
+    from time import monotonic_ns
+except ImportError:
+    try:
+        from time import monotonic
+    except ImportError:
+        monotonic = None
+    
+    if monotonic is None:
+        # Python 2: clock_gettime(CLOCK_MONOTONIC) from the C library on
+        # Linux, macOS 10.12+ and 64-bit BSDs, the wall clock elsewhere (the
+        # clock IDs differ between systems, and a wrong one may well be a
+        # valid clock running at another pace). The wall clock can be
+        # stepped back; LogWriter clamps the deltas it writes at 0 so time
+        # still never runs backwards in a log.
+        import ctypes
+        import ctypes.util
+        import sys
+        
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        
+        # timespec holds a time_t, which is a long except on 32-bit BSDs
+        _CLOCK_MONOTONIC = {'linux': 1, 'darwin': 6}
+        if ctypes.sizeof(ctypes.c_long) == 8:
+            _CLOCK_MONOTONIC.update({'freebsd': 4, 'netbsd': 3, 'openbsd': 3})
+        _CLOCK_MONOTONIC = _CLOCK_MONOTONIC.get(sys.platform.rstrip('0123456789'))
+        
+        _clock_gettime = None
+        if _CLOCK_MONOTONIC is not None:
+            try:
+                _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                    use_errno=True)
+                _clock_gettime = _libc.clock_gettime
+                _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+            except (OSError, AttributeError):
+                _clock_gettime = None
+        _now = _timespec()
+        _nowLock = Lock()
+        
+        if _clock_gettime is not None and \
+           _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(_now)) == 0:
+            def monotonic_ns():
+                with _nowLock:
+                    _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(_now))
+                    return _now.tv_sec * 1000000000 + _now.tv_nsec
+        else:
+            def monotonic_ns():
+                return int(time() * 1000000000)
+    else:
+        def monotonic_ns():
+            return int(monotonic() * 1000000000)
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import msgpack
 
+from ant.core.constants import MESSAGE_TX_SYNC, MESSAGE_CHANNEL_ID
+from ant.core.exceptions import MessageError
+from ant.core.message import Message, ChannelMessage
+
 EVENT_OPEN = 0x01
 EVENT_CLOSE = 0x02
 EVENT_READ = 0x03
 EVENT_WRITE = 0x04
+EVENT_MESSAGE_READ = 0x05  # [EVENT, TIME, TYPE, CHANNEL, PAYLOAD], see EventMachine
+EVENT_MESSAGE_WRITE = 0x06
+MESSAGE_EVENTS = {EVENT_MESSAGE_READ: EVENT_READ, EVENT_MESSAGE_WRITE: EVENT_WRITE}
+
+LOG_MAGIC = 'ANT-LOG'
+LOG_VERSION_1 = 0x01  # [MAGIC, VERSION], records carry time() in seconds
+LOG_VERSION_2 = 0x02  # [MAGIC, VERSION, START, STICK(, CODEC)], records carry deltas
+LOG_VERSION = LOG_VERSION_2
+
+# Compressed logs store [BASE, CRC32, DATA] blocks instead of bare records,
+# DATA being the compressed records and BASE the time their deltas start from.
+CODECS = {'zlib': (zlib.compress, zlib.decompress)}
+if lzma is not None:
+    CODECS['lzma'] = (lzma.compress, lzma.decompress)
+
+INDEX_MAGIC = 'ANT-LOG-INDEX'
+INDEX_VERSION_1 = 0x01
+INDEX_VERSION_2 = 0x02  # adds message types
+INDEX_VERSION = INDEX_VERSION_2
+
+CHANNEL_MESSAGES = frozenset(type_ for type_, class_ in Message.TYPES.items()
+                             if issubclass(class_, ChannelMessage))
+
+
+_UINT = {0xCC: Struct(b'>B'), 0xCD: Struct(b'>H'), 0xCE: Struct(b'>I'),
+         0xCF: Struct(b'>Q'), 0xD0: Struct(b'>b'), 0xD1: Struct(b'>h'),
+         0xD2: Struct(b'>i'), 0xD3: Struct(b'>q')}
+_RAW = {0xC4: Struct(b'>B'), 0xC5: Struct(b'>H'), 0xC6: Struct(b'>I'),
+        0xD9: Struct(b'>B'), 0xDA: Struct(b'>H'), 0xDB: Struct(b'>I')}
+_ARRAY = {0xDC: Struct(b'>H'), 0xDD: Struct(b'>I')}
+_BYTE = _UINT[0xCC]
+
+
+def _slicer(map_):
+    try:
+        view = memoryview(map_)
+    except TypeError:
+        # Python 2 mmaps only have the old buffer interface
+        return lambda start, end: buffer(map_, start, end - start)  # pylint: disable=undefined-variable
+    return lambda start, end: view[start:end]
+
+
+def _spans(buffer_, final=False):
+    # Find the frames in raw bytes, returning their (start, end) offsets and
+    # the offset of the trailing incomplete bytes. A frame failing its
+    # checksum is line noise: scanning resumes at the next sync byte after
+    # its start, so a bogus length cannot swallow the frames that follow.
+    # With `final` no more bytes will come, so a frame running past the end
+    # is noise too.
+    spans = []
+    i, length = 0, len(buffer_)
+    while i < length:
+        if buffer_[i] != MESSAGE_TX_SYNC:
+            i = buffer_.find(b'\xA4', i + 1)
+            if i < 0:
+                i = length
+            continue
+        end = i + buffer_[i + 1] + 4 if i + 1 < length else length + 1
+        if end > length:
+            if not final:
+                break
+            i += 1
+            continue
+        checksum = 0
+        for byte in buffer_[i:end]:
+            checksum ^= byte
+        if checksum:
+            i += 1
+            continue
+        spans.append((i, end))
+        i = end
+    return spans, i
+
+
+def _vectorSpans(buffer_, final=False):
+    # _spans() with numpy, for large buffers: the checksums of all candidate
+    # frames come from prefix XORs at once (a frame XORs to zero, checksum
+    # byte included). Returns arrays of the frames' start and end offsets and
+    # of how far the bytes had to reach for _spans() to find each (noise
+    # before a frame may claim more bytes than the frame itself), and the
+    # offset of the trailing incomplete bytes.
+    length = len(buffer_)
+    if not length:
+        none = numpy.zeros(0, dtype=numpy.int64)
+        return none, none, none, 0
+    buf = numpy.frombuffer(bytes(buffer_), dtype=numpy.uint8)
+    syncs = numpy.flatnonzero(buf == MESSAGE_TX_SYNC)
+    count = len(syncs)
+    sizes = buf[numpy.minimum(syncs + 1, length - 1)].astype(numpy.int64)
+    ends = numpy.where(syncs + 1 < length, syncs + sizes + 4, length + 1)
+    complete = ends <= length
+    
+    xors = numpy.zeros(length + 1, dtype=numpy.uint8)
+    numpy.bitwise_xor.accumulate(buf, out=xors[1:])
+    valid = complete & \
+        ((xors[numpy.minimum(ends, length)] ^ xors[syncs]) == 0)
+    
+    # A frame goes on at the first sync byte after it, anything else at the
+    # next one. Runs of sync bytes stepping to the next are taken whole, so
+    # this only loops over frames with sync bytes in them.
+    steps = numpy.where(valid, numpy.searchsorted(syncs, ends),
+                        numpy.arange(1, count + 1))
+    jumps = numpy.flatnonzero(steps != numpy.arange(1, count + 1)).tolist()
+    steps = steps.tolist()
+    visited = numpy.zeros(count, dtype=bool)
+    i = 0
+    while i < count:
+        k = bisect_left(jumps, i)
+        if k == len(jumps):
+            visited[i:] = True
+            break
+        visited[i:jumps[k] + 1] = True
+        i = steps[jumps[k]]
+    
+    rest = length
+    if not final:
+        # stop at the first frame running past the end
+        waiting = numpy.flatnonzero(visited & ~complete)
+        if len(waiting):
+            visited[waiting[0]:] = False
+            rest = syncs[waiting[0]]
+    visited = numpy.flatnonzero(visited)
+    reach = numpy.maximum.accumulate(numpy.minimum(ends[visited], length))
+    taken = valid[visited]
+    visited = visited[taken]
+    return syncs[visited], ends[visited], reach[taken], rest
+
+
+def _frames(buffer_):
+    # Split raw bytes into (type, payload) frames, returning the frames and
+    # the trailing incomplete bytes, see _spans()
+    spans, rest = _spans(buffer_)
+    return ([(buffer_[start + 2], buffer_[start + 3:end - 1]) for start, end in spans],
+            buffer_[rest:])
+
+
+class LogIndex(object):
+    # A log is split into blocks starting on record (and frame) boundaries
+    # roughly every INTERVAL nanoseconds, or on every compressed block. Each
+    # block is [OFFSET, TIME, BASE]:
+    # its file offset, the time of its first record and the time of the record
+    # before it, which v2 deltas are relative to. `channels`, `devices` and
+    # `types` map to the sorted numbers of the blocks they show up in.
+    INTERVAL = 1000000000
+    
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.blocks = []
+        self.channels = {}
+        self.devices = {}
+        self.types = {}
+        self._ids = {}
+        self._times = []
+        self._pending = {EVENT_READ: bytearray(), EVENT_WRITE: bytearray()}
+    
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as fd:
+            data = msgpack.unpackb(fd.read())
+        if len(data) < 5 or data[0] != INDEX_MAGIC or \
+           (data[1], len(data)) not in ((INDEX_VERSION_1, 5), (INDEX_VERSION_2, 6)):
+            raise IOError('Could not open log index (unknown format).')
+        
+        index = cls()
+        index.blocks, index.channels = data[2], data[3]
+        index.devices = dict(((number, type_, transmissionType), blocks) for
+                             number, type_, transmissionType, blocks in data[4])
+        # types are unknown to version 1 indexes, they select every block
+        index.types = data[5] if data[1] == INDEX_VERSION_2 else None
+        return index
+    
+    def save(self, filename):
+        devices = [list(device) + [blocks] for device, blocks in self.devices.items()]
+        data = [INDEX_MAGIC, INDEX_VERSION, self.blocks, self.channels, devices,
+                self.types]
+        with open(filename, 'wb') as fd:
+            fd.write(msgpack.packb(data, use_bin_type=True))
+    
+    @property
+    def aligned(self):
+        # whether a block may start here without splitting a frame
+        pending = self._pending
+        return not (pending[EVENT_READ] or pending[EVENT_WRITE])
+    
+    def due(self, timestamp):
+        blocks = self.blocks
+        return self.aligned and \
+               (not blocks or timestamp - blocks[-1][1] >= self.interval)
+    
+    def addBlock(self, offset, timestamp, base):
+        self.blocks.append([offset, timestamp, base])
+    
+    def scan(self, event, data):
+        if data is None:
+            return
+        
+        block = len(self.blocks) - 1
+        if event in MESSAGE_EVENTS:
+            # already a message, nothing to frame
+            self._scanFrame(data[0], bytearray(data[2]), block)
+        elif event in (EVENT_READ, EVENT_WRITE):
+            frames, self._pending[event] = _frames(self._pending[event] + data)
+            for type_, payload in frames:
+                self._scanFrame(type_, payload, block)
+    
+    def _scanFrame(self, type_, payload, block):
+        self._mark(self.types, type_, block)
+        if type_ not in CHANNEL_MESSAGES or not payload:
+            return
+        
+        channel = payload[0]
+        if type_ == MESSAGE_CHANNEL_ID and len(payload) == 5:
+            self._ids[channel] = (payload[1] | payload[2] << 8, payload[3],
+                                  payload[4])
+        self._mark(self.channels, channel, block)
+        device = self._ids.get(channel)
+        if device is not None:
+            self._mark(self.devices, device, block)
+    
+    def successor(self):
+        # empty index for the log that continues this one
+        index = self.__class__(self.interval)
+        index._ids.update(self._ids)
+        return index
+    
+    @staticmethod
+    def _mark(index, key, block):
+        blocks = index.setdefault(key, [])
+        if not blocks or blocks[-1] != block:
+            blocks.append(block)
+    
+    @property
+    def times(self):
+        times = self._times
+        if len(times) != len(self.blocks):
+            times = self._times = [block[1] for block in self.blocks]
+        return times
+    
+    def find(self, timestamp):
+        # number of the block a record at `timestamp` would be in
+        return max(bisect_right(self.times, timestamp) - 1, 0)
+    
+    def select(self, channel=None, device=None, start=None, end=None,
+               type_=None):
+        first, last = 0, len(self.blocks)
+        if start is not None:
+            first = self.find(start)
+        if end is not None:
+            last = bisect_left(self.times, end)
+        
+        selected = range(first, last)
+        if channel is not None:
+            selected = [b for b in self.channels.get(channel, ()) if first <= b < last]
+        if device is not None:
+            matches = set(self.devices.get(tuple(device), ()))
+            selected = [b for b in selected if b in matches]
+        if type_ is not None and self.types is not None:
+            matches = set(self.types.get(type_, ()))
+            selected = [b for b in selected if b in matches]
+        return list(selected)
 
 
 class LogReader(object):
-    def __init__(self, filename):
+    CHUNK_SIZE = 64 * 1024
+    
+    def __init__(self, filename, chunkSize=CHUNK_SIZE):
         self.is_open = False
+        self.chunkSize = chunkSize
         self.open(filename)
     
     def __del__(self):
         if self.is_open:
             self.fd.close()
     
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        event = self.read()
+        if event is None:
+            raise StopIteration
+        return event
+    next = __next__
+    
     def open(self, filename):
         if self.is_open == True:
             self.close()
         
-        self.fd = open(filename, 'r')
+        self.fd = open(filename, 'rb')
         self.is_open = True
         self.unpacker = msgpack.Unpacker()
+        self._origin = 0
+        self._peeked = None
+        self._records = deque()
+        self._block = 0
         
-        # Here be dragons
-        self.unpacker.feed(self.fd.read())
-        self.fd.close()
-        
-        header = self.unpacker.unpack()
-        if len(header) != 2 or header[0] != 'ANT-LOG' or header[1] != 0x01:
+        header = self._next()
+        if not isinstance(header, (list, tuple)) or len(header) < 2 or \
+           header[0] != LOG_MAGIC:
+            self.close()
             raise IOError('Could not open log file (unknown format).')
+        
+        version, codec = header[1], None
+        if version == LOG_VERSION_1 and len(header) == 2:
+            self.startTime, self.stick = None, None
+            self.timescale = 1
+        elif version == LOG_VERSION_2 and len(header) in (4, 5):
+            self.startTime, self.stick = header[2:4]
+            self.timescale = 1000000000
+            self._time = self.startTime
+            if len(header) == 5:
+                codec = header[4]
+        else:
+            self.close()
+            raise IOError('Could not open log file (unsupported version).')
+        
+        if codec is not None and codec not in CODECS:
+            self.close()
+            raise IOError('Could not open log file (unsupported compression).')
+        self.version = version
+        self.codec = codec
+        self._start = self.tell()
+        
+        self.index = None
+        if version == LOG_VERSION_2 and exists(filename + '.idx'):
+            self.index = LogIndex.load(filename + '.idx')
     
     def close(self):
         if self.is_open:
             self.fd.close()
             self.is_open = False
     
+    def _next(self):
+        # the file is fed to the unpacker one chunk at a time, so memory use
+        # does not depend on the size of the log
+        unpacker = self.unpacker
+        while True:
+            try:
+                return next(unpacker)
+            except StopIteration:
+                chunk = self.fd.read(self.chunkSize)
+                if not chunk:
+                    return None
+                unpacker.feed(chunk)
+    
+    def _unpack(self):
+        if self.codec is None:
+            return self._next()
+        
+        records = self._records
+        while not records:
+            self._block = self.tell()
+            block = self._next()
+            if block is None:
+                return None
+            
+            base, crc, data = block
+            data = CODECS[self.codec][1](data)
+            if zlib.crc32(data) & 0xFFFFFFFF != crc:
+                raise IOError('Could not read log file (bad block checksum).')
+            
+            unpacker = msgpack.Unpacker()
+            unpacker.feed(data)
+            records.extend(unpacker)
+            self._time = base
+        return records.popleft()
+    
+    def _jump(self, offset, base):
+        self.fd.seek(offset)
+        self.unpacker = msgpack.Unpacker()
+        self._origin = offset
+        self._peeked = None
+        self._records.clear()
+        self._time = base
+    
+    def tell(self):
+        # file offset of the next record, or of its block if compressed
+        if self._records:
+            return self._block
+        return self._origin + self.unpacker.tell()
+    
     def read(self):
-        try:
-            return self.unpacker.unpack()
-        except StopIteration:
+        event = self._peeked
+        if event is not None:
+            self._peeked = None
+            return event
+        
+        event = self._unpack()
+        if event is not None and self.version == LOG_VERSION_2:
+            # v2 stores nanoseconds since the previous record
+            self._time += event[1]
+            event[1] = self._time
+        return event
+    
+    def rewind(self):
+        self._jump(self._start, self.startTime)
+    
+    def seek(self, timestamp):
+        # Move to the first record at or after `timestamp`, given in the same
+        # units read() returns. Without an index the log is scanned from the
+        # start.
+        index = self.index
+        if index is not None and index.blocks:
+            offset, _, base = index.blocks[index.find(timestamp)]
+            self._jump(offset, base)
+        else:
+            self.rewind()
+        
+        while True:
+            event = self.read()
+            if event is None or event[1] >= timestamp:
+                self._peeked = event
+                return
+    
+    def iter(self, channel=None, device=None, start=None, end=None, type_=None):
+        # Yield the records between `start` (inclusive) and `end` (exclusive).
+        # With an index, only blocks where `channel`, `device` (a (number,
+        # type, transmission type) tuple) or message `type_` were seen are
+        # read; raw reads and writes still have to be framed by the caller.
+        index = self.index
+        if index is None:
+            if channel is not None or device is not None or type_ is not None:
+                raise IOError('Could not filter log (no index).')
+            runs = [(None, None)]
+        else:
+            blocks = index.blocks
+            runs = []
+            for block in index.select(channel, device, start, end, type_):
+                if runs and runs[-1][1] == block:
+                    runs[-1][1] = block + 1
+                else:
+                    runs.append([block, block + 1])
+        
+        for first, last in runs:
+            if first is not None:
+                events = self.readBlocks(first, last)
+            elif start is not None:
+                self.seek(start)
+                events = self
+            else:
+                self.rewind()
+                events = self
+            
+            for event in events:
+                if end is not None and event[1] >= end:
+                    break
+                if start is None or event[1] >= start:
+                    yield event
+    
+    def readBlocks(self, first, last=None):
+        # yield the records in index blocks `first` to `last` (exclusive)
+        blocks = self.index.blocks
+        offset, _, base = blocks[first]
+        self._jump(offset, base)
+        
+        stop = None
+        if last is not None and last < len(blocks):
+            stop = blocks[last][0]
+        while stop is None or self.tell() < stop:
+            event = self.read()
+            if event is None:
+                break
+            yield event
+
+
+class MappedLogReader(LogReader):
+    # Reads a log through a read-only memory map. Records are parsed in place
+    # and their data handed out as zero-copy slices of the map (memoryview,
+    # or buffer on Python 2), so readers of the same file, in this or other
+    # processes, share the page cache instead of holding copies.
+    def open(self, filename):
+        self._map = None
+        super(MappedLogReader, self).open(filename)
+        
+        self._map = mmap(self.fd.fileno(), 0, access=ACCESS_READ)
+        self._size = len(self._map)
+        self._slice = _slicer(self._map)
+        self.rewind()
+    
+    def close(self):
+        # the map goes away with the last slice handed out
+        self._map = self._slice = None
+        super(MappedLogReader, self).close()
+    
+    def _jump(self, offset, base):
+        if self._map is None:
+            return super(MappedLogReader, self)._jump(offset, base)
+        
+        self._pos = offset
+        self._peeked = None
+        self._records.clear()
+        self._time = base
+    
+    def tell(self):
+        if self._map is None:
+            return super(MappedLogReader, self).tell()
+        if self._records:
+            return self._block
+        return self._pos
+    
+    def _next(self):
+        if self._map is None:
+            return super(MappedLogReader, self)._next()
+        
+        if self._pos >= self._size:
             return None
+        try:
+            value, self._pos = self._decode(self._pos)
+        except (StructError, EOFError):
+            return None  # truncated record at the end of the log
+        return value
+    
+    def _decode(self, pos):
+        # the subset of msgpack logs are made of: arrays, integers, nil,
+        # booleans and raw strings
+        map_ = self._map
+        byte = _BYTE.unpack_from(map_, pos)[0]
+        pos += 1
+        
+        if byte <= 0x7F:
+            return byte, pos
+        if byte >= 0xE0:
+            return byte - 0x100, pos
+        if 0x90 <= byte <= 0x9F or byte in _ARRAY:
+            if byte in _ARRAY:
+                length = _ARRAY[byte].unpack_from(map_, pos)[0]
+                pos += _ARRAY[byte].size
+            else:
+                length = byte & 0x0F
+            items = []
+            for _ in range(length):
+                item, pos = self._decode(pos)
+                items.append(item)
+            return items, pos
+        if 0xA0 <= byte <= 0xBF or byte in _RAW:
+            if byte in _RAW:
+                length = _RAW[byte].unpack_from(map_, pos)[0]
+                pos += _RAW[byte].size
+            else:
+                length = byte & 0x1F
+            end = pos + length
+            if end > self._size:
+                raise EOFError()
+            if byte in (0xC4, 0xC5, 0xC6):
+                return self._slice(pos, end), end
+            return map_[pos:end], end  # strings are copied, they are short
+        if byte in _UINT:
+            return _UINT[byte].unpack_from(map_, pos)[0], pos + _UINT[byte].size
+        if byte == 0xC0:
+            return None, pos
+        if byte in (0xC2, 0xC3):
+            return byte == 0xC3, pos
+        raise IOError('Could not read log file (unexpected msgpack type 0x%.2x).' % byte)
 
 
 class LogWriter(object):
-    def __init__(self, filename=''):
-        self.packer = msgpack.Packer()
+    BLOCK_SIZE = 64 * 1024
+    
+    def __init__(self, filename='', stick=None, index=False, compression=None,
+                 blockSize=BLOCK_SIZE, maxBytes=None, maxAge=None):
+        if compression is not None and compression not in CODECS:
+            raise IOError('Could not open log file (unsupported compression).')
+        
+        self.packer = msgpack.Packer(use_bin_type=True)
+        self.stick = stick
+        self.indexed = index
+        self.index = None
+        self.compression = compression
+        self.blockSize = blockSize
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
         self.is_open = False
+        self._lock = Lock()
+        self._closers = []
         self.open(filename)
     
     def __del__(self):
@@ -85,34 +701,163 @@ class LogWriter(object):
             self.fd.close()
     
     def open(self, filename=''):
+        if self.is_open == True:
+            self.close()
+        
+        # with rotation, `filename` names the first segment, later ones get
+        # a sequence number (or a timestamp, if no name was given)
+        self._template = filename
+        self.segment = 0
+        self.segments = []
+        
+        # timestamps are monotonic, START anchors them to the wall clock
+        self._last = monotonic_ns()
+        # compressed blocks are cut on frame boundaries, which takes an index
+        indexed = self.indexed or self.compression is not None
+        self._begin(int(time() * 1000000000), LogIndex() if indexed else None)
+    
+    def _begin(self, start, index):
+        filename = self._template
         if filename == '':
             filename = datetime.datetime.now().isoformat() + '.ant'
-        self.filename = filename
+        elif self.segment > 0:
+            root, ext = splitext(filename)
+            filename = '%s.%d%s' % (root, self.segment, ext)
         
-        if self.is_open == True:
-            self.close()
+        # nothing changes until the segment is set up, so failing to (e.g.
+        # on a full disk) can simply be retried
+        self.packer = msgpack.Packer(use_bin_type=True)
+        header = [LOG_MAGIC, LOG_VERSION, start, self.stick]
+        if self.compression is not None:
+            header.append(self.compression)
+        header = self.packer.pack(header)
+        fd = open(filename, 'wb')
+        try:
+            fd.write(header)
+        except (IOError, OSError):
+            fd.close()
+            raise
         
-        self.fd = open(filename, 'w')
+        self.filename = filename
+        self.segments.append(filename)
+        self.fd = fd
         self.is_open = True
-        self.packer = msgpack.Packer()
+        if exists(filename + '.idx'):
+            # stale until this segment's own index is saved, would mislead
+            # readers (forever, should we never get to save it)
+            remove(filename + '.idx')
+        
+        self._time = self._segmentStart = start
+        self._offset = len(header)
         
-        header = ['ANT-LOG', 0x01]  # [MAGIC, VERSION]
-        self.fd.write(self.packer.pack(header))
+        self.index = index
+        self._block = []
+        self._blockBase = self._blockLength = 0
     
     def close(self):
         if self.is_open:
-            self.fd.close()
+            if self._block:
+                self.fd.write(self._compress())
+            self._retire(self.fd, self.index if self.indexed else None,
+                         self.filename)
             self.is_open = False
+        
+        closers, self._closers = self._closers, []
+        for closer in closers:
+            closer.join()
     
-    def _logEvent(self, event, data=None):
-        ev = [event, int(time()), data]
+    @staticmethod
+    def _retire(fd, index, filename):
+        fd.close()
+        if index is not None:
+            index.save(filename + '.idx')
+    
+    def _rotating(self):
+        if self.maxBytes is not None and self._offset >= self.maxBytes:
+            due = True
+        elif self.maxAge is not None and \
+             self._time - self._segmentStart >= self.maxAge * 1000000000:
+            due = True
+        else:
+            return False
+        return self.index is None or self.index.aligned
+    
+    def _rotate(self):
+        # The next segment starts right away, the finished one is closed (and
+        # its index saved) in the background. Segments are self-contained, the
+        # new header starts off where the last record left.
+        fd, index, filename = self.fd, self.index, self.filename
+        if self._block:
+            fd.write(self._compress())
         
+        self.segment += 1
+        try:
+            self._begin(self._time, index.successor() if index is not None else None)
+        except (IOError, OSError):
+            self.segment -= 1
+            raise
+        
+        closer = Thread(target=self._retire,
+                        args=(fd, index if self.indexed else None, filename))
+        closer.start()
+        self._closers = [c for c in self._closers if c.is_alive()] + [closer]
+    
+    def _compress(self):
+        data = b''.join(self._block)
+        crc = zlib.crc32(data) & 0xFFFFFFFF
+        data = CODECS[self.compression][0](data)
+        block = self.packer.pack([self._blockBase, crc, data])
+        
+        self._offset += len(block)
+        self._block = []
+        self._blockLength = 0
+        return block
+    
+    def _pack(self, event, timestamp, data):
+        # never negative: the clock may be the wall clock (see monotonic_ns),
+        # and queued events may be stamped slightly out of order by threads
+        delta, self._last = max(timestamp - self._last, 0), timestamp
         if data is None:
-            ev = ev[0:-1]
-        elif len(data) == 0:
+            packed = self.packer.pack([event, delta])
+        elif event in MESSAGE_EVENTS:
+            packed = self.packer.pack([event, delta, data[0], data[1], data[2]])
+        else:
+            packed = self.packer.pack([event, delta, data])
+        
+        base = self._time
+        self._time += delta
+        index = self.index
+        if self.compression is None:
+            if index is not None:
+                if index.due(self._time):
+                    index.addBlock(self._offset, self._time, base)
+                index.scan(event, data)
+            self._offset += len(packed)
+            return packed
+        
+        # compressed records are held back until their block is complete
+        ready = b''
+        if self._blockLength >= self.blockSize and index.aligned:
+            ready = self._compress()
+        if not self._block:
+            self._blockBase = base
+            index.addBlock(self._offset, self._time, base)
+        self._block.append(packed)
+        self._blockLength += len(packed)
+        index.scan(event, data)
+        return ready
+    
+    def _logEvent(self, event, data=None):
+        if data is not None and len(data) == 0:
             return
         
-        self.fd.write(self.packer.pack(ev))
+        # the driver logs from the pump and from writing threads
+        with self._lock:
+            packed = self._pack(event, monotonic_ns(), data)
+            if packed:
+                self.fd.write(packed)
+            if self._rotating():
+                self._rotate()
     
     def logOpen(self):
         self._logEvent(EVENT_OPEN)
@@ -125,3 +870,330 @@ class LogWriter(object):
     
     def logWrite(self, data):
         self._logEvent(EVENT_WRITE, data)
+    
+    @staticmethod
+    def _message(msg):
+        # (TYPE, CHANNEL, PAYLOAD), CHANNEL is None for non-channel messages
+        payload, type_ = bytearray(msg.payload), msg.type
+        channel = payload[0] if type_ in CHANNEL_MESSAGES and payload else None
+        return type_, channel, bytes(payload)
+    
+    def logMessageRead(self, msg):
+        self._logEvent(EVENT_MESSAGE_READ, self._message(msg))
+    
+    def logMessageWrite(self, msg):
+        self._logEvent(EVENT_MESSAGE_WRITE, self._message(msg))
+
+
+# Events are handed to a bounded queue and packed/written in batches by a
+# background thread, so the driver never waits on disk I/O. When the queue is
+# full events are dropped instead: `dropped` counts the lost events and
+# `overflows` the number of times the queue ran full. Writes (and rotations)
+# that failed (e.g. the disk is full) are counted in `errors`, their events
+# lost; the queue keeps draining so flush() and close() never hang on them.
+class AsyncLogWriter(LogWriter):
+    QUEUE_SIZE = 4096
+    BATCH_SIZE = 256
+    
+    def __init__(self, filename='', queueSize=QUEUE_SIZE, batchSize=BATCH_SIZE,
+                 **kwargs):
+        self.queue = Queue(queueSize)
+        self.batchSize = batchSize
+        self.overflows = 0
+        self.dropped = 0
+        self.errors = 0
+        self._overflowing = False
+        self._statsLock = Lock()
+        self._writer = None
+        super(AsyncLogWriter, self).__init__(filename, **kwargs)
+    
+    def open(self, filename=''):
+        super(AsyncLogWriter, self).open(filename)
+        
+        writer = self._writer = Thread(target=self._run, name='LogWriter')
+        writer.daemon = True
+        writer.start()
+    
+    def close(self):
+        if self.is_open:
+            self.queue.put(None)
+            self._writer.join()
+            self._writer = None
+            super(AsyncLogWriter, self).close()
+    
+    def flush(self):
+        # wait until everything queued so far is written
+        self.queue.join()
+        self.fd.flush()
+    
+    def _logEvent(self, event, data=None):
+        if data is not None and len(data) == 0:
+            return
+        
+        try:
+            self.queue.put_nowait((event, monotonic_ns(), data))
+        except Full:
+            with self._statsLock:
+                self.dropped += 1
+                if not self._overflowing:
+                    self._overflowing = True
+                    self.overflows += 1
+        else:
+            if self._overflowing:
+                self._overflowing = False
+    
+    def _run(self):
+        queue, batchSize = self.queue, self.batchSize
+        pack = self._pack
+        
+        running = True
+        while running:
+            batch = [queue.get()]
+            try:
+                while len(batch) < batchSize:
+                    batch.append(queue.get_nowait())
+            except Empty:
+                pass
+            
+            chunk = []
+            try:
+                for event in batch:
+                    if event is None:
+                        running = False
+                        continue
+                    
+                    try:
+                        chunk.append(pack(*event))
+                        if self._rotating():
+                            self._write(chunk)
+                            chunk = []
+                            self._rotate()
+                    except (IOError, OSError):
+                        self._failed()
+                self._write(chunk)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+    
+    def _write(self, chunk):
+        if chunk:
+            try:
+                self.fd.write(b''.join(chunk))
+            except (IOError, OSError):
+                self._failed()
+    
+    def _failed(self):
+        with self._statsLock:
+            self.errors += 1
+
+
+FRAME_BATCH = 4096
+
+
+def _encode(type_, payload):
+    frame = bytearray((MESSAGE_TX_SYNC, len(payload), type_))
+    frame += payload
+    frame.append(reduce(xor, frame))
+    return frame
+
+
+def frameEvents(events, batchSize=FRAME_BATCH):
+    # Frame the raw reads and writes in `events` (as returned by LogReader),
+    # yielding (TIMESTAMP, EVENT, FRAME) as frames complete. Frames failing
+    # their checksum are skipped up to the next sync byte. Captured messages
+    # are re-encoded, with EVENT their raw counterpart.
+    if numpy is not None:
+        return _frameBatches(events, batchSize)
+    return _frameEvents(events)
+
+
+def _frameEvents(events):
+    buffers = {EVENT_READ: bytearray(), EVENT_WRITE: bytearray()}
+    stamps = {}
+    for event in events:
+        direction = event[0]
+        if direction in MESSAGE_EVENTS:
+            yield event[1], MESSAGE_EVENTS[direction], _encode(event[2], event[4])
+            continue
+        if direction not in buffers:
+            continue
+        
+        buffer_ = buffers[direction] + event[2]
+        spans, rest = _spans(buffer_)
+        for start, end in spans:
+            yield event[1], direction, buffer_[start:end]
+        buffers[direction] = buffer_[rest:]
+        stamps[direction] = event[1]
+    
+    # what is left never completed, but may hide frames behind noise
+    for direction, buffer_ in buffers.items():
+        for start, end in _spans(buffer_, final=True)[0]:
+            yield stamps[direction], direction, buffer_[start:end]
+
+
+def _frameBatches(events, batchSize):
+    # frameEvents() with numpy: `batchSize` events at a time, each direction
+    # framed in one go. Frames are yielded as (and when) _frameEvents() would,
+    # in the order of the events their timestamps come from.
+    buffers = {EVENT_READ: bytearray(), EVENT_WRITE: bytearray()}
+    stamps = {}
+    events = iter(events)
+    while True:
+        batch = list(islice(events, batchSize))
+        if not batch:
+            break
+        
+        # per direction, the events with its bytes
+        numbers = dict((direction, []) for direction in buffers)
+        messages = []
+        for number, event in enumerate(batch):
+            direction = event[0]
+            if direction in MESSAGE_EVENTS:
+                messages.append(number)
+            elif direction in numbers:
+                numbers[direction].append(number)
+        
+        # the yielded tuples, the events completing them and their offsets
+        out, owners, offsets = [], [], []
+        if messages:
+            out.append([(batch[number][1], MESSAGE_EVENTS[batch[number][0]],
+                         _encode(batch[number][2], batch[number][4]))
+                        for number in messages])
+            owners.append(messages)
+            offsets.append([0] * len(messages))
+        for direction, numbers_ in numbers.items():
+            if not numbers_:
+                continue
+            buffer_, bounds = buffers[direction], []
+            for number in numbers_:
+                buffer_ += batch[number][2]
+                bounds.append(len(buffer_))
+            
+            starts, ends, reach, rest = _vectorSpans(buffer_)
+            completing = numpy.array(numbers_)[
+                numpy.searchsorted(bounds, reach - 1, side='right')].tolist()
+            starts, ends = starts.tolist(), ends.tolist()
+            out.append([(batch[number][1], direction, buffer_[start:end])
+                        for number, start, end in zip(completing, starts, ends)])
+            owners.append(completing)
+            offsets.append(starts)
+            buffers[direction] = buffer_[rest:]
+            stamps[direction] = batch[numbers_[-1]][1]
+        
+        if len(out) == 1:
+            for item in out[0]:
+                yield item
+        elif out:
+            out = [item for items in out for item in items]
+            order = numpy.lexsort((numpy.concatenate(offsets),
+                                   numpy.concatenate(owners)))
+            for k in order.tolist():
+                yield out[k]
+    
+    # what is left never completed, but may hide frames behind noise
+    for direction, buffer_ in buffers.items():
+        starts, ends, _, _ = _vectorSpans(buffer_, final=True)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield stamps[direction], direction, buffer_[start:end]
+
+
+def decodeEvents(events):
+    # decode frameEvents() frames, yielding (TIMESTAMP, EVENT, MESSAGE)
+    for timestamp, direction, frame in frameEvents(events):
+        try:
+            msg = Message.decode(frame)
+        except MessageError:
+            continue
+        yield timestamp, direction, msg
+
+
+def _merge(sources):
+    # k-way merge of iterables of (TIMESTAMP, ...) tuples already in order,
+    # ties are broken by source order
+    heap = []
+    for i, source in enumerate(sources):
+        source = iter(source)
+        for item in source:
+            heap.append((item[0], i, item, source))
+            break
+    heapify(heap)
+    
+    while heap:
+        _, i, item, source = heap[0]
+        yield item
+        for item in source:
+            heapreplace(heap, (item[0], i, item, source))
+            break
+        else:
+            heappop(heap)
+
+
+def _tagged(log, source, start, end):
+    # a log's records as (TIMESTAMP, SOURCE, EVENT), TIMESTAMP in nanoseconds
+    scale = 1000000000 // log.timescale
+    try:
+        for event in log.iter(start=None if start is None else start // scale):
+            timestamp = event[1] * scale
+            if end is not None and timestamp >= end:
+                break
+            if start is None or timestamp >= start:
+                yield timestamp, source, event
+    finally:
+        log.close()
+
+
+def mergeLogs(filenames, start=None, end=None, reader=LogReader):
+    # Interleave captures from several sticks by time, yielding
+    # (TIMESTAMP, SOURCE, EVENT) with TIMESTAMP in nanoseconds and SOURCE the
+    # stick named in the log header, or the file name if there is none. Logs
+    # are streamed, only one record per log is held at a time.
+    sources = []
+    for filename in filenames:
+        log = reader(filename)
+        source = log.stick if log.stick is not None else filename
+        sources.append(_tagged(log, source, start, end))
+    return _merge(sources)
+
+
+def _decodeTask(task):
+    filename, first, last = task
+    log = LogReader(filename)
+    events = log if first is None else log.readBlocks(first, last)
+    
+    scale = 1000000000 // log.timescale
+    decoded = [(timestamp * scale, direction, msg) for timestamp, direction, msg
+               in decodeEvents(events)]
+    log.close()
+    return decoded
+
+
+def decodeLogs(filenames, processes=None, blocksPerTask=64):
+    # Decode several captures on a process pool, returning every message as
+    # (TIMESTAMP, EVENT, MESSAGE) in timestamp order, TIMESTAMP in nanoseconds.
+    # Indexed logs are split into tasks of `blocksPerTask` blocks, which is
+    # safe as blocks start on frame boundaries.
+    tasks, owners = [], []
+    for i, filename in enumerate(filenames):
+        log = LogReader(filename)
+        index = log.index
+        log.close()
+        if index is None or len(index.blocks) <= blocksPerTask:
+            tasks.append((filename, None, None))
+            owners.append(i)
+            continue
+        for first in range(0, len(index.blocks), blocksPerTask):
+            tasks.append((filename, first, first + blocksPerTask))
+            owners.append(i)
+    
+    pool = Pool(processes)
+    try:
+        results = pool.map(_decodeTask, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    
+    # tasks of a file are in order already, only files need merging
+    perFile = [[] for _ in filenames]
+    for owner, decoded in zip(owners, results):
+        perFile[owner].extend(decoded)
+    return list(_merge(perFile))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring, invalid-name
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import argparse
+import datetime
+import errno
+import sys
+from binascii import hexlify
+from time import mktime
+
+from ant.core.constants import MESSAGE_CHANNEL_ID
+from ant.core.exceptions import MessageError
+from ant.core.log import (LogReader, MappedLogReader, CHANNEL_MESSAGES,
+                          EVENT_READ, EVENT_WRITE, MESSAGE_EVENTS, frameEvents,
+                          _merge)
+from ant.core.message import Message
+
+DIRECTIONS = {'read': EVENT_READ, 'write': EVENT_WRITE}
+LABELS = {EVENT_READ: 'R', EVENT_WRITE: 'W'}
+
+
+def _time(value):
+    # seconds since the epoch or an ISO 8601 local time, in nanoseconds
+    try:
+        return int(float(value) * 1000000000)
+    except ValueError:
+        pass
+    for format_ in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            moment = datetime.datetime.strptime(value, format_)
+        except ValueError:
+            continue
+        return int(mktime(moment.timetuple())) * 1000000000 + \
+               moment.microsecond * 1000
+    raise argparse.ArgumentTypeError('invalid time: %r' % value)
+
+
+def _device(value):
+    # NUMBER[:TYPE[:TRANSMISSION_TYPE]], unset fields match anything
+    try:
+        fields = [int(field, 0) for field in value.split(':')]
+    except ValueError:
+        fields = []
+    if not 1 <= len(fields) <= 3:
+        raise argparse.ArgumentTypeError('invalid device: %r' % value)
+    return tuple(fields + [None] * (3 - len(fields)))
+
+
+def _formatTime(timestamp):
+    seconds, nanoseconds = divmod(timestamp, 1000000000)
+    moment = datetime.datetime.fromtimestamp(seconds)
+    return '%s.%09d' % (moment.strftime('%Y-%m-%dT%H:%M:%S'), nanoseconds)
+
+
+def parser():
+    parser_ = argparse.ArgumentParser(
+        prog='ant-log', description='Print the messages in ANT capture logs, '
+        'several logs are interleaved by time.')
+    parser_.add_argument('logs', metavar='LOG', nargs='+')
+    parser_.add_argument('-s', '--start', type=_time,
+                         help='skip messages before START (seconds since the '
+                              'epoch or ISO 8601 local time)')
+    parser_.add_argument('-e', '--end', type=_time,
+                         help='stop at END (same format as START)')
+    parser_.add_argument('-d', '--direction', choices=sorted(DIRECTIONS))
+    parser_.add_argument('-c', '--channel', type=int, action='append',
+                         help='only messages on CHANNEL (repeatable)')
+    parser_.add_argument('-t', '--type', type=lambda value: int(value, 0),
+                         action='append',
+                         help='only messages of TYPE, e.g. 0x4E (repeatable)')
+    parser_.add_argument('-D', '--device', type=_device,
+                         help='only messages for channels set to DEVICE, as '
+                              'NUMBER[:TYPE[:TRANSMISSION_TYPE]]')
+    parser_.add_argument('-x', '--hex', action='store_true',
+                         help='print raw frames instead of decoded messages')
+    parser_.add_argument('-m', '--mmap', action='store_true',
+                         help='read logs through memory maps')
+    return parser_
+
+
+class Query(object):
+    def __init__(self, start=None, end=None, direction=None, channel=None,
+                 type_=None, device=None):
+        self.start = start
+        self.end = end
+        self.direction = DIRECTIONS.get(direction, direction)
+        self.channels = frozenset(channel) if channel else None
+        self.types = frozenset(type_) if type_ else None
+        self.device = device
+    
+    def _events(self, log):
+        if self.device is not None:
+            # channels are matched to devices by their Channel ID commands,
+            # which may be anywhere before (and written, not read): read
+            # everything, frames() filters
+            for event in log:
+                yield event
+            return
+        
+        scale = 1000000000 // log.timescale
+        start = None if self.start is None else self.start // scale
+        end = None if self.end is None else -(-self.end // scale)
+        
+        # with an index, whole blocks are skipped for channel/type queries
+        channel = type_ = None
+        if log.index is not None:
+            if self.channels is not None and len(self.channels) == 1:
+                channel = next(iter(self.channels))
+            if self.types is not None and len(self.types) == 1:
+                type_ = next(iter(self.types))
+        events = log.iter(channel=channel, start=start, end=end, type_=type_)
+        
+        direction = self.direction
+        for event in events:
+            if direction is None or MESSAGE_EVENTS.get(event[0], event[0]) == direction:
+                yield event
+    
+    def frames(self, log, source=None):
+        # matching frames in `log` as (TIMESTAMP, SOURCE, EVENT, FRAME), the
+        # raw frame header is checked before anything gets decoded
+        scale = 1000000000 // log.timescale
+        start, end = self.start, self.end
+        channels, types, device = self.channels, self.types, self.device
+        wanted = self.direction
+        matching = set()  # the channels currently set to `device`
+        
+        for timestamp, direction, frame in frameEvents(self._events(log)):
+            type_ = frame[2]
+            isChannel = type_ in CHANNEL_MESSAGES and frame[1] > 0
+            if device is not None and isChannel and \
+               type_ == MESSAGE_CHANNEL_ID and frame[1] == 5:
+                known = (frame[4] | frame[5] << 8, frame[6], frame[7])
+                if all(want is None or want == have
+                       for want, have in zip(device, known)):
+                    matching.add(frame[3])
+                else:
+                    matching.discard(frame[3])
+            
+            timestamp *= scale
+            if (start is not None and timestamp < start) or \
+               (end is not None and timestamp >= end):
+                continue
+            if wanted is not None and direction != wanted:
+                continue
+            if types is not None and type_ not in types:
+                continue
+            if channels is not None and (not isChannel or frame[3] not in channels):
+                continue
+            if device is not None and (not isChannel or frame[3] not in matching):
+                continue
+            yield timestamp, source, direction, frame
+
+
+def _format(timestamp, source, direction, frame, raw):
+    if raw:
+        text = hexlify(bytes(frame)).decode('ascii').upper()
+    else:
+        try:
+            msg = Message.decode(frame)
+        except MessageError as err:
+            text = '<undecodable: %s>' % err
+        else:
+            text = '%s %s' % (msg, hexlify(bytes(msg.payload)).decode('ascii').upper())
+    
+    fields = [_formatTime(timestamp), LABELS[direction]]
+    if source is not None:
+        if isinstance(source, bytes):
+            source = source.decode('utf-8', 'replace')
+        fields.append('%s' % source)
+    fields.append(text)
+    return ' '.join(fields)
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    query = Query(args.start, args.end, args.direction, args.channel, args.type,
+                  args.device)
+    reader = MappedLogReader if args.mmap else LogReader
+    
+    try:
+        logs = [reader(filename) for filename in args.logs]
+    except (IOError, OSError) as err:
+        print('ant-log: %s' % err, file=sys.stderr)
+        return 1
+    
+    if len(logs) == 1:
+        frames = query.frames(logs[0])
+    else:
+        frames = _merge([query.frames(log, log.stick if log.stick is not None
+                                      else filename)
+                         for log, filename in zip(logs, args.logs)])
+    
+    write = sys.stdout.write
+    try:
+        for timestamp, source, direction, frame in frames:
+            write(_format(timestamp, source, direction, frame, args.hex) + '\n')
+        sys.stdout.flush()
+    except IOError as err:
+        if err.errno != errno.EPIPE:
+            raise
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -26,7 +26,7 @@
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
-from struct import pack, unpack
+from struct import pack, unpack, Struct
 
 from ant.core import constants
 from ant.core.constants import MESSAGE_TX_SYNC, RESPONSE_NO_ERROR
@@ -72,6 +72,9 @@ class Message(object):
     CORRUPTED = 'corrupted'
     MALFORMED = 'malformed'
     
+    # 9 bytes of data message, plus a flag byte and every extended field
+    MAX_PAYLOAD = 19
+    
     
     def __init__(self, payload=None):
         self._payload = None
@@ -82,7 +85,7 @@ class Message(object):
         return self._payload
     @payload.setter
     def payload(self, payload):
-        if len(payload) > 9:
+        if len(payload) > self.MAX_PAYLOAD:
             raise MessageError('Could not set payload (payload too long).',
                                internal=Message.MALFORMED)
         self._payload = payload
@@ -253,6 +256,41 @@ class ChannelSearchTimeoutMessage(ChannelMessage):
         self._payload[1] = timeout
 
 
+class ChannelLowPrioritySearchTimeoutMessage(ChannelMessage):
+    type = constants.MESSAGE_CHANNEL_LOW_PRIORITY_SEARCH_TIMEOUT
+    
+    def __init__(self, number=0x00, timeout=0x02):
+        super(ChannelLowPrioritySearchTimeoutMessage, self).__init__(
+            payload=bytearray(1), number=number)
+        self.timeout = timeout
+    
+    @property
+    def timeout(self):
+        return self._payload[1]
+    @timeout.setter
+    def timeout(self, timeout):
+        self._payload[1] = timeout
+
+
+class ChannelProximitySearchMessage(ChannelMessage):
+    type = constants.MESSAGE_PROXIMITY_SEARCH
+    
+    def __init__(self, number=0x00, threshold=0x00):
+        super(ChannelProximitySearchMessage, self).__init__(payload=bytearray(1),
+                                                            number=number)
+        self.threshold = threshold
+    
+    @property
+    def threshold(self):
+        return self._payload[1]
+    @threshold.setter
+    def threshold(self, threshold):
+        if (threshold > 10) or (threshold < 0):
+            raise MessageError('Could not set proximity threshold (out of range).')
+        
+        self._payload[1] = threshold
+
+
 class ChannelFrequencyMessage(ChannelMessage):
     type = constants.MESSAGE_CHANNEL_FREQUENCY
     
@@ -306,6 +344,24 @@ class NetworkKeyMessage(Message):
         self._payload[1:] = key
 
 
+class LibConfigMessage(Message):
+    type = constants.MESSAGE_LIB_CONFIG
+    
+    def __init__(self, config=0x00):
+        super(LibConfigMessage, self).__init__(payload=bytearray(2))
+        self.config = config
+    
+    @property
+    def config(self):
+        return self._payload[1]
+    @config.setter
+    def config(self, config):
+        if (config > 0xFF) or (config < 0x00):
+            raise MessageError('Could not set lib config (out of range).')
+        
+        self._payload[1] = config
+
+
 class TXPowerMessage(Message):
     type = constants.MESSAGE_TX_POWER
     
@@ -343,6 +399,14 @@ class ChannelCloseMessage(ChannelMessage):
         super(ChannelCloseMessage, self).__init__(number=number)
 
 
+class OpenRxScanModeMessage(ChannelMessage):
+    type = constants.MESSAGE_OPEN_RX_SCAN_MODE
+    
+    def __init__(self):
+        # scan mode always runs on channel 0
+        super(OpenRxScanModeMessage, self).__init__()
+
+
 class ChannelRequestMessage(ChannelMessage):
     type = constants.MESSAGE_CHANNEL_REQUEST
     
@@ -362,25 +426,136 @@ class ChannelRequestMessage(ChannelMessage):
 
 
 # Data messages
-class ChannelBroadcastDataMessage(ChannelMessage):
+def _extendedLayout(flag):
+    # offsets of the extended fields present with `flag`, and the payload
+    # length they add up to
+    offsets, offset = {}, 10
+    for field, size in ((constants.LIB_CONFIG_CHANNEL_ID, 4),
+                        (constants.LIB_CONFIG_RSSI, 3),
+                        (constants.LIB_CONFIG_RX_TIMESTAMP, 2)):
+        if flag & field:
+            offsets[field] = offset
+            offset += size
+    return offsets, offset
+
+_EXTENDED_FLAGS = (constants.LIB_CONFIG_CHANNEL_ID | constants.LIB_CONFIG_RSSI |
+                   constants.LIB_CONFIG_RX_TIMESTAMP)
+_EXTENDED_LAYOUTS = dict((flag, _extendedLayout(flag)) for flag in range(0x100)
+                         if flag == flag & _EXTENDED_FLAGS)
+_CHANNEL_ID = Struct(b'<HBB')
+_RSSI = Struct(b'<Bbb')
+_TIMESTAMP = Struct(b'<H')
+
+
+class ChannelDataMessage(ChannelMessage):
+    # Data messages may carry extended data after their 8 bytes: a flag byte
+    # and the fields it flags (LIB_CONFIG_*), always in the same order, so
+    # each field sits at a fixed offset for a given flag. Fields that are not
+    # there read as None.
+    
+    @property
+    def data(self):
+        return self._payload[1:9]
+    
+    @property
+    def flag(self):
+        payload = self._payload
+        return payload[9] if len(payload) > 9 else None
+    
+    def _offset(self, field):
+        payload = self._payload
+        if len(payload) < 11:
+            return None
+        offsets, length = _EXTENDED_LAYOUTS[payload[9] & _EXTENDED_FLAGS]
+        if len(payload) < length:
+            raise MessageError('Could not read extended data (payload too short).',
+                               internal=Message.MALFORMED)
+        return offsets.get(field)
+    
+    @property
+    def channelID(self):
+        # (device number, device type, transmission type)
+        offset = self._offset(constants.LIB_CONFIG_CHANNEL_ID)
+        if offset is None:
+            return None
+        return _CHANNEL_ID.unpack_from(self._payload, offset)
+    
+    @property
+    def deviceNumber(self):
+        channelID = self.channelID
+        return channelID[0] if channelID is not None else None
+    
+    @property
+    def deviceType(self):
+        channelID = self.channelID
+        return channelID[1] if channelID is not None else None
+    
+    @property
+    def transmissionType(self):
+        channelID = self.channelID
+        return channelID[2] if channelID is not None else None
+    
+    @property
+    def rssi(self):
+        # (measurement type, RSSI, threshold), RSSI and threshold in dBm
+        offset = self._offset(constants.LIB_CONFIG_RSSI)
+        if offset is None:
+            return None
+        return _RSSI.unpack_from(self._payload, offset)
+    
+    @property
+    def rxTimestamp(self):
+        # in 1/32768 seconds, rolling over every 2 seconds
+        offset = self._offset(constants.LIB_CONFIG_RX_TIMESTAMP)
+        if offset is None:
+            return None
+        return _TIMESTAMP.unpack_from(self._payload, offset)[0]
+
+
+class ChannelBroadcastDataMessage(ChannelDataMessage):
     type = constants.MESSAGE_CHANNEL_BROADCAST_DATA
     
     def __init__(self, number=0x00, data=b'\x00' * 7):
         super(ChannelBroadcastDataMessage, self).__init__(payload=data, number=number)
 
 
-class ChannelAcknowledgedDataMessage(ChannelMessage):
+class ChannelAcknowledgedDataMessage(ChannelDataMessage):
     type = constants.MESSAGE_CHANNEL_ACKNOWLEDGED_DATA
     
     def __init__(self, number=0x00, data=b'\x00' * 7):
         super(ChannelAcknowledgedDataMessage, self).__init__(payload=data, number=number)
 
 
-class ChannelBurstDataMessage(ChannelMessage):
+class ChannelBurstDataMessage(ChannelDataMessage):
+    # The upper 3 bits of the channel byte are the sequence number: 0 for the
+    # first packet of a transfer, then 1, 2, 3, 1... with LAST_PACKET set on
+    # the last one.
     type = constants.MESSAGE_CHANNEL_BURST_DATA
+    LAST_PACKET = 0x04
     
-    def __init__(self, number=0x00, data=b'\x00' * 7):
+    def __init__(self, number=0x00, data=b'\x00' * 7, sequence=0x00):
         super(ChannelBurstDataMessage, self).__init__(payload=data, number=number)
+        self.sequenceNumber = sequence
+    
+    @property
+    def channelNumber(self):
+        return self._payload[0] & 0x1F
+    @channelNumber.setter
+    def channelNumber(self, number):
+        if (number > 0x1F) or (number < 0x00):
+            raise MessageError('Could not set channel number (out of range).')
+        
+        self._payload[0] = self._payload[0] & 0xE0 | number
+    
+    @property
+    def sequenceNumber(self):
+        return self._payload[0] >> 5
+    @sequenceNumber.setter
+    def sequenceNumber(self, sequence):
+        if (sequence > 0x07) or (sequence < 0x00):
+            raise MessageError('Could not set sequence number (out of range).')
+        
+        self._payload[0] = self._payload[0] & 0x1F | sequence << 5
 
 
 # Channel event messages
@@ -26,14 +26,28 @@
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+from array import array
+from collections import deque, namedtuple
+from heapq import nlargest
+from time import sleep, time
 from uuid import uuid4
-from threading import Lock
+from threading import Event, Lock, Thread, Timer
+
+from usb.core import USBError
 
 from ant.core import event, message
 from ant.core.constants import (EVENT_CHANNEL_CLOSED, CHANNEL_TYPE_TWOWAY_RECEIVE,
-                                MESSAGE_CAPABILITIES)
-from ant.core.exceptions import ChannelError, MessageError, NodeError
-from ant.core.message import ChannelMessage
+                                MESSAGE_CAPABILITIES, LIB_CONFIG_CHANNEL_ID,
+                                LIB_CONFIG_RSSI, LIB_CONFIG_RX_TIMESTAMP,
+                                EVENT_RX_SEARCH_TIMEOUT, EVENT_RX_FAIL_GO_TO_SEARCH,
+                                EVENT_TRANSFER_TX_COMPLETED, EVENT_TRANSFER_TX_FAILED,
+                                MESSAGE_CHANNEL_ACKNOWLEDGED_DATA,
+                                EVENT_TRANSFER_RX_FAILED, MESSAGE_CHANNEL_BURST_DATA,
+                                EVENT_TRANSFER_TX_START, EVENT_TRANSFER_NEXT_DATA_BLOCK,
+                                EVENT_TX)
+from ant.core.exceptions import ChannelError, DriverError, MessageError, NodeError
+from ant.core.message import (ChannelMessage, ChannelDataMessage,
+                              ChannelEventResponseMessage, ChannelBurstDataMessage)
 
 
 class Network(object):
@@ -64,7 +78,13 @@ class Channel(event.EventCallback):
         self.type = CHANNEL_TYPE_TWOWAY_RECEIVE
         self.network = None
         self.device = None
+        self.opened = False
+        self.scanMode = False  # opened in continuous scan mode
+        self._transfers = None
+        self._sendersLock = Lock()
         self._searchTimeout = None
+        self._lowPrioritySearchTimeout = None
+        self._proximityBin = None
         self._period = None
         self._frequency = None
     
@@ -77,6 +97,7 @@ class Channel(event.EventCallback):
         
         self.type = channelType
         self.network = network
+        self.node.allocator.reserve(self)
     
     def setID(self, devType, devNum, transType):
         msg = message.ChannelIDMessage(self.number, devNum, devType, transType)
@@ -100,6 +121,39 @@ class Channel(event.EventCallback):
         
         self._searchTimeout = timeout
     
+    @property
+    def lowPrioritySearchTimeout(self):
+        return self._lowPrioritySearchTimeout
+    @lowPrioritySearchTimeout.setter
+    def lowPrioritySearchTimeout(self, timeout):
+        # A low priority search (in 2.5 second counts) runs before the regular
+        # one and does not interrupt other open channels. Set searchTimeout
+        # to 0 to search with low priority only.
+        msg = message.ChannelLowPrioritySearchTimeoutMessage(self.number, timeout)
+        try:
+            self.node.evm.writeMessage(msg).waitForAck(msg)
+        except MessageError as err:
+            raise ChannelError('%s: could not set low priority search timeout: %s'
+                               % (self, err))
+        
+        self._lowPrioritySearchTimeout = timeout
+    
+    @property
+    def proximityBin(self):
+        return self._proximityBin
+    @proximityBin.setter
+    def proximityBin(self, threshold):
+        # Only pair with devices within proximity bin `threshold` (1 is the
+        # closest, 10 the farthest, 0 turns it off). It applies to the next
+        # search.
+        msg = message.ChannelProximitySearchMessage(self.number, threshold)
+        try:
+            self.node.evm.writeMessage(msg).waitForAck(msg)
+        except MessageError as err:
+            raise ChannelError('%s: could not set proximity search: %s' % (self, err))
+        
+        self._proximityBin = threshold
+    
     @property
     def period(self):
         return self._period
@@ -134,22 +188,40 @@ class Channel(event.EventCallback):
         except MessageError as err:
             raise ChannelError('%s: could not open: %s' % (self, err))
         
+        self.opened = True
+        self.scanMode = False
+        evm.registerCallback(self)
+    
+    def openRxScanMode(self):
+        # Open in continuous scan mode, receiving from every device in range
+        # on this channel's frequency. It takes over the whole stick: only
+        # channel 0 may be used and it has to be a receive channel.
+        if self.number != 0:
+            raise ChannelError('%s: could not open scan mode: not channel 0' % self)
+        
+        msg = message.OpenRxScanModeMessage()
+        evm = self.node.evm
+        try:
+            evm.writeMessage(msg).waitForAck(msg)
+        except MessageError as err:
+            raise ChannelError('%s: could not open scan mode: %s' % (self, err))
+        
+        self.opened = True
+        self.scanMode = True
         evm.registerCallback(self)
     
     def close(self):
         msg = message.ChannelCloseMessage(number=self.number)
         evm = self.node.evm
+        closed = evm.expectEvent(self.number, EVENT_CHANNEL_CLOSED)
         try:
             evm.writeMessage(msg).waitForAck(msg)
+            evm.waitForEvent(closed)
         except MessageError as err:
+            evm.events.cancel(closed)
             raise ChannelError('%s: could not close: %s' % (self, err))
         
-        while True:
-            msg = evm.waitForMessage(message.ChannelEventResponseMessage)
-            if msg.channelNumber == self.number and \
-               msg.messageCode == EVENT_CHANNEL_CLOSED:
-                break
-        
+        self.opened = False
         evm.removeCallback(self)
     
     def unassign(self):
@@ -160,34 +232,1007 @@ class Channel(event.EventCallback):
             raise ChannelError('%s: could not unassign: %s' % (self, err))
         
         self.network = None
+        self.node.allocator.release(self)
+    
+    def replayMessages(self):
+        # the commands bringing a freshly reset stick to this channel's
+        # state, see Node.replay
+        if self.network is None:
+            return []
+        number = self.number
+        messages = [message.ChannelAssignMessage(number, self.type, self.network.number)]
+        device = self.device
+        if device is not None:
+            messages.append(message.ChannelIDMessage(number, device.number, device.type,
+                                                     device.transmissionType))
+        for value, class_ in ((self._period, message.ChannelPeriodMessage),
+                              (self._frequency, message.ChannelFrequencyMessage),
+                              (self._searchTimeout, message.ChannelSearchTimeoutMessage),
+                              (self._lowPrioritySearchTimeout,
+                               message.ChannelLowPrioritySearchTimeoutMessage),
+                              (self._proximityBin, message.ChannelProximitySearchMessage)):
+            if value is not None:
+                messages.append(class_(number, value))
+        if self.opened and self.scanMode:
+            messages.append(message.OpenRxScanModeMessage())
+        elif self.opened:
+            messages.append(message.ChannelOpenMessage(number))
+        return messages
     
     def registerCallback(self, callback):
         with self.evmCallbackLock:
             self.callbacks.add(callback)
     
+    def removeCallback(self, callback):
+        with self.evmCallbackLock:
+            self.callbacks.discard(callback)
+    
     def process(self, msg):
         with self.evmCallbackLock:
             if isinstance(msg, ChannelMessage) and msg.channelNumber == self.number:
+                if isinstance(msg, ChannelEventResponseMessage) and \
+                   msg.messageID == 1 and msg.messageCode == EVENT_CHANNEL_CLOSED:
+                    self.opened = False  # closed by the stick, e.g. search timeout
                 for callback in self.callbacks:
                     try:
                         callback.process(msg, self)
                     except Exception as err:  # pylint: disable=broad-except
                         print(err)
+            else:
+                return
+        
+        # Senders are not callbacks: they write from the event pump, and
+        # sending from a callback must not wait for the callback lock.
+        sender = self._transfers
+        if sender is not None:
+            sender.process(msg, self)
+    
+    @property
+    def transfers(self):
+        # the channel's TransferSender
+        with self._sendersLock:
+            sender = self._transfers
+            if sender is None:
+                sender = self._transfers = TransferSender(self)
+            return sender
+    
+    def sendAcknowledged(self, data, retries=None):
+        # Send `data` (8 bytes) as acknowledged data, returning a Future for
+        # the number of attempts it took, see TransferSender.
+        return self.transfers.send(data, retries)
+    
+    def sendBurst(self, data, retries=None):
+        # Send `data` as a burst transfer, padded to 8 byte packets. The
+        # returned TransferFuture tracks the packets written and resolves to
+        # the number of attempts it took.
+        return self.transfers.sendBurst(data, retries)
     
     def __str__(self):
         rawstr = '<channel %d' % self.number
         device = self.device
         if device is not None:
-            rawstr += ' (0x%.2x)' % device
+            rawstr += ' (0x%.4x)' % device.number
         return rawstr + '>'
 
 
+class _Transfer(object):
+    # an acknowledged data transfer, bursts are below
+    kind = 'acknowledged'
+    
+    duration = 0  # seconds writing takes, on top of the sender's timeout
+    
+    def __init__(self, data, retries):
+        self.data = data
+        self.retries = retries
+        self.attempts = 0
+        self.pending = False  # a resend is scheduled
+        self.timer = None  # the attempt's deadline
+        self.future = event.Future()
+    
+    def start(self, sender):
+        channel = sender.channel
+        channel.node.evm.writeMessage(
+            message.ChannelAcknowledgedDataMessage(channel.number, self.data))
+    
+    def step(self, code):
+        pass
+    
+    def stop(self):
+        timer = self.timer
+        if timer is not None:
+            timer.cancel()
+
+
+class _Burst(_Transfer):
+    # Packets are encoded once, `blockSize` to a batch written in one go. The
+    # first batch goes right away, the next ones when the stick asks for
+    # more (EVENT_TRANSFER_TX_START or EVENT_TRANSFER_NEXT_DATA_BLOCK) or
+    # after `pace` seconds, whichever comes first.
+    kind = 'burst'
+    
+    def __init__(self, number, data, retries, blockSize, pace):
+        super(_Burst, self).__init__(data, retries)
+        packets, data = [], bytearray(data)
+        data += bytearray(-len(data) % 8)
+        counter = 0
+        for offset in range(0, len(data), 8):
+            sequence = counter
+            if offset + 8 >= len(data):
+                sequence |= ChannelBurstDataMessage.LAST_PACKET
+            packets.append(ChannelBurstDataMessage(number, data[offset:offset + 8],
+                                                   sequence))
+            counter = counter % 3 + 1
+        
+        self.blocks = [event.MessageBatch(packets[first:first + blockSize])
+                       for first in range(0, len(packets), blockSize)]
+        self.pace = pace
+        self.duration = len(self.blocks) * pace
+        self.future = event.TransferFuture(len(packets))
+        self._more = None
+        self._stopped = True
+    
+    def start(self, sender):
+        self._more = more = Event()
+        self._stopped = False
+        self.future.sent = 0
+        writer = Thread(target=self._run, args=(sender, more), name='BurstWriter')
+        writer.daemon = True
+        writer.start()
+    
+    def _run(self, sender, more):
+        evm, future = sender.channel.node.evm, self.future
+        for i, block in enumerate(self.blocks):
+            if i:
+                more.wait(self.pace)
+                more.clear()
+            if self._stopped or self._more is not more:
+                return  # failed, or restarted meanwhile
+            future.sent += len(block.messages)
+            try:
+                evm.writeMessage(block)
+            except Exception as err:  # pylint: disable=broad-except
+                sender.fail(self, err)
+                return
+    
+    def step(self, code):
+        if code in (EVENT_TRANSFER_TX_START, EVENT_TRANSFER_NEXT_DATA_BLOCK):
+            self._more.set()
+    
+    def stop(self):
+        super(_Burst, self).stop()
+        self._stopped = True
+        if self._more is not None:
+            self._more.set()
+
+
+class TransferSender(object):
+    # Acknowledged and burst transfers of a channel. The stick handles one at
+    # a time per channel (and tells them apart by nothing but timing), so
+    # transfers are queued and the next one starts as soon as the last
+    # completes; channels send independently of each other. A transfer that
+    # fails (EVENT_TRANSFER_TX_FAILED, or a response error such as
+    # TRANSFER_IN_PROGRESS) is sent again after BACKOFF seconds, doubled on
+    # each attempt, up to `retries` times. An attempt not answered within
+    # `timeout` seconds (plus the time a burst takes to write) fails the
+    # transfer, so a lost event does not hold up the channel's queue.
+    RETRIES = 3
+    BACKOFF = 0.05
+    TIMEOUT = 2.0
+    
+    def __init__(self, channel, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT):
+        self.channel = channel
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.lock = Lock()
+        self._queue = deque()
+        self._current = None
+    
+    def send(self, data, retries=None):
+        return self._send(_Transfer(data, self.retries if retries is None else retries))
+    
+    def sendBurst(self, data, retries=None, blockSize=8, pace=0.05):
+        if not len(data):
+            raise ChannelError('%s: could not send burst: no data' % self.channel)
+        return self._send(_Burst(self.channel.number, data,
+                                 self.retries if retries is None else retries,
+                                 blockSize, pace))
+    
+    def _send(self, transfer):
+        with self.lock:
+            self._queue.append(transfer)
+            if self._current is not None:
+                return transfer.future
+            transfer = self._advance()
+        self._start(transfer)
+        return transfer.future
+    
+    def _advance(self):
+        queue = self._queue
+        current = self._current = queue.popleft() if queue else None
+        return current
+    
+    def _start(self, transfer):
+        transfer.attempts += 1
+        transfer.pending = False
+        timer = transfer.timer = Timer(self.timeout + transfer.duration, self._expire,
+                                       args=(transfer, transfer.attempts))
+        timer.daemon = True
+        timer.start()
+        try:
+            transfer.start(self)
+        except Exception as err:  # pylint: disable=broad-except
+            self.fail(transfer, err)
+    
+    def fail(self, transfer, err):
+        # the transfer could not be written
+        self._finish(transfer, ChannelError('%s: could not send: %s' %
+                                            (self.channel, err)))
+    
+    def _finish(self, transfer, error=None):
+        with self.lock:
+            if self._current is not transfer:
+                return
+            following = self._advance()
+        transfer.stop()
+        if error is None:
+            transfer.future.setResult(transfer.attempts)
+        else:
+            transfer.future.setException(error)
+        if following is not None:
+            self._start(following)
+    
+    def _retry(self, transfer, reason):
+        if transfer.pending:
+            return
+        transfer.stop()
+        if transfer.attempts > transfer.retries:
+            self._finish(transfer, ChannelError('%s: %s transfer failed (%s)' %
+                                                (self.channel, transfer.kind, reason)))
+            return
+        transfer.pending = True
+        timer = Timer(self.backoff * 2 ** (transfer.attempts - 1), self._resend,
+                      args=(transfer,))
+        timer.daemon = True
+        timer.start()
+    
+    def _expire(self, transfer, attempt):
+        with self.lock:
+            if self._current is not transfer or transfer.attempts != attempt or \
+               transfer.pending:
+                return  # answered meanwhile
+        self._finish(transfer, ChannelError('%s: %s transfer timed out' %
+                                            (self.channel, transfer.kind)))
+    
+    def _resend(self, transfer):
+        with self.lock:
+            if self._current is not transfer:
+                return  # cancelled meanwhile
+        self._start(transfer)
+    
+    def process(self, msg, channel):  # pylint: disable=unused-argument
+        if not isinstance(msg, ChannelEventResponseMessage):
+            return
+        transfer, code = self._current, msg.messageCode
+        if transfer is None:
+            return
+        
+        if msg.messageID == 1:
+            if code == EVENT_CHANNEL_CLOSED:
+                self.cancel(ChannelError('%s: channel closed' % self.channel))
+            elif transfer.pending:
+                return
+            elif code == EVENT_TRANSFER_TX_COMPLETED:
+                self._finish(transfer)
+            elif code == EVENT_TRANSFER_TX_FAILED:
+                self._retry(transfer, 'transfer failed')
+            else:
+                transfer.step(code)
+        elif msg.messageID in (MESSAGE_CHANNEL_ACKNOWLEDGED_DATA,
+                               MESSAGE_CHANNEL_BURST_DATA) and code:
+            self._retry(transfer, 'response 0x%.2x' % code)
+    
+    def cancel(self, error):
+        # fail the transfers in flight or queued
+        with self.lock:
+            transfers = ([self._current] if self._current is not None else []) + \
+                        list(self._queue)
+            self._queue.clear()
+            self._current = None
+        for transfer in transfers:
+            transfer.stop()
+            transfer.future.setException(error)
+
+
+class BurstReceiver(object):
+    # Reassembles the burst transfers a channel receives. Packets are copied
+    # into one buffer, grown by doubling and reused across transfers, and
+    # each complete transfer is handed to callback.process(data, channel),
+    # as bytes or, with `copy` off, as a memoryview of the buffer that is
+    # only valid until the callback returns. Transfers with a gap in their
+    # sequence numbers or ended by EVENT_TRANSFER_RX_FAILED are dropped and
+    # counted in `failures`.
+    BUFFER_SIZE = 4096
+    
+    def __init__(self, channel, callback, copy=True, size=BUFFER_SIZE):
+        self.channel = channel
+        self.callback = callback
+        self.copy = copy
+        self.transfers = 0
+        self.failures = 0
+        self._buffer = bytearray(size)
+        self._length = 0
+        self._next = None  # sequence number expected, None between transfers
+        channel.registerCallback(self)
+    
+    def process(self, msg, channel):
+        if isinstance(msg, ChannelBurstDataMessage):
+            self._packet(msg, channel)
+        elif isinstance(msg, ChannelEventResponseMessage) and msg.messageID == 1 \
+             and msg.messageCode == EVENT_TRANSFER_RX_FAILED:
+            self._fail()
+    
+    def _fail(self):
+        if self._next is not None:
+            self.failures += 1
+            self._next = None
+    
+    def _packet(self, msg, channel):
+        sequence = msg.sequenceNumber
+        counter = sequence & 0x03
+        if counter == 0:
+            self._fail()  # a new transfer cuts the last one short
+            self._length = 0
+        elif counter != self._next:
+            self._fail()
+            return
+        
+        buffer_, length = self._buffer, self._length
+        if length + 8 > len(buffer_):
+            buffer_.extend(bytearray(len(buffer_)))
+        buffer_[length:length + 8] = msg.payload[1:9]
+        self._length = length = length + 8
+        
+        if not sequence & ChannelBurstDataMessage.LAST_PACKET:
+            self._next = counter % 3 + 1
+            return
+        self._next = None
+        self.transfers += 1
+        view = memoryview(buffer_)
+        try:
+            data = view[:length]
+            self.callback.process(data.tobytes() if self.copy else data, channel)
+        finally:
+            if not self.copy:
+                # the buffer cannot grow while views of it are around
+                for export in (data, view):
+                    try:
+                        export.release()
+                    except AttributeError:
+                        pass  # Python 2 memoryviews go with their references
+
+
+class Broadcaster(object):
+    # Keeps a transmit channel's broadcast buffer fed: on each EVENT_TX, once
+    # per channel period, the next payload goes out. Payloads come either
+    # from `pages`, a rotation of 8 byte pages encoded once up front, or from
+    # provider(channel), called each period and returning 8 bytes (None to
+    # leave the last ones to be sent again), which are copied into a frame
+    # encoded once. Either way nothing is allocated per period.
+    def __init__(self, channel, provider=None, pages=None):
+        if (provider is None) == (not pages):
+            raise ChannelError('%s: could not broadcast: need a provider or pages'
+                               % channel)
+        self.channel = channel
+        self.provider = provider
+        self.sent = 0
+        if provider is not None:
+            self._frames = [event.MessageFrame(
+                message.ChannelBroadcastDataMessage(channel.number, bytearray(8)))]
+        else:
+            self._frames = [event.MessageFrame(
+                message.ChannelBroadcastDataMessage(channel.number, page))
+                            for page in pages]
+        self._page = 0
+        self.running = False
+    
+    def start(self):
+        # queue the first payload, then follow the channel's EVENT_TX
+        self.running = True
+        self.channel.registerCallback(self)
+        self._send()
+    
+    def stop(self):
+        self.running = False
+        self.channel.removeCallback(self)
+    
+    def process(self, msg, channel):  # pylint: disable=unused-argument
+        if self.running and isinstance(msg, ChannelEventResponseMessage) and \
+           msg.messageID == 1 and msg.messageCode == EVENT_TX:
+            self._send()
+    
+    def _send(self):
+        provider = self.provider
+        if provider is None:
+            frames = self._frames
+            frame = frames[self._page]
+            self._page = (self._page + 1) % len(frames)
+        else:
+            data = provider(self.channel)
+            if data is None:
+                return
+            frame = self._frames[0]
+            frame.update(data)
+        self.channel.node.evm.writeMessage(frame)
+        self.sent += 1
+
+
+class ScanReceiver(object):
+    # Splits the data a channel receives in continuous scan mode by device,
+    # using the channel ID in each message's extended data. Callbacks set for
+    # a (number, type, transmission type) device are called as
+    # callback.process(msg, device); data from other devices goes to
+    # `discovery`, if set.
+    
+    def __init__(self, channel, discovery=None):
+        self.channel = channel
+        self.discovery = discovery
+        self.devices = {}
+        self.lock = Lock()
+        channel.registerCallback(self)
+    
+    def open(self):
+        node = self.channel.node
+        if not node.libConfig & LIB_CONFIG_CHANNEL_ID:
+            node.setLibConfig(node.libConfig | LIB_CONFIG_CHANNEL_ID)
+        self.channel.openRxScanMode()
+    
+    def registerCallback(self, device, callback):
+        with self.lock:
+            self.devices.setdefault(tuple(device), set()).add(callback)
+    
+    def removeCallback(self, device, callback):
+        with self.lock:
+            callbacks = self.devices.get(tuple(device))
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self.devices[tuple(device)]
+    
+    def process(self, msg, channel):  # pylint: disable=unused-argument
+        if not isinstance(msg, message.ChannelDataMessage):
+            return
+        try:
+            device = msg.channelID
+        except MessageError:
+            return
+        if device is None:
+            return
+        
+        with self.lock:
+            callbacks = self.devices.get(device)
+            if callbacks is None:
+                callbacks = () if self.discovery is None else (self.discovery,)
+            for callback in callbacks:
+                try:
+                    callback.process(msg, device)
+                except Exception as err:  # pylint: disable=broad-except
+                    print(err)
+
+
+DeviceState = namedtuple('DeviceState', 'number type transmissionType firstSeen '
+                         'lastSeen count rate rssi payload')
+
+
+class DeviceTracker(event.EventCallback):
+    # Remembers the devices heard: when they were first and last seen, how
+    # many messages they sent and how often, their last 8 data bytes and RSSI.
+    # State is kept in flat arrays, one slot per device, so a device costs a
+    # few dozen bytes; get() builds a DeviceState snapshot. Devices are told
+    # apart by their extended data channel ID or, failing that, by the ID
+    # set on the channel. Devices not heard for `timeout` seconds are
+    # forgotten.
+    TIMEOUT = 60
+    CAPACITY = 256
+    SMOOTHING = 0.1  # weight of the latest interval in the rate average
+    NO_RSSI = -128
+    
+    def __init__(self, node=None, timeout=TIMEOUT, capacity=CAPACITY):
+        self.node = node
+        self.timeout = timeout
+        self.lock = Lock()
+        self._slots = {}
+        self._keys = []
+        self._free = []
+        self._firstSeen = array(str('d'))
+        self._lastSeen = array(str('d'))
+        self._intervals = array(str('d'))
+        self._counts = array(str('L'))
+        self._rssi = array(str('b'))
+        self._payloads = bytearray()
+        self._expired = time()
+        self._grow(capacity)
+    
+    def _grow(self, count):
+        start = len(self._keys)
+        self._keys.extend([None] * count)
+        self._free.extend(range(start + count - 1, start - 1, -1))
+        for column in (self._firstSeen, self._lastSeen, self._intervals):
+            column.extend([0.0] * count)
+        self._counts.extend([0] * count)
+        self._rssi.extend([self.NO_RSSI] * count)
+        self._payloads.extend(bytearray(8 * count))
+    
+    def process(self, msg):
+        if not isinstance(msg, ChannelDataMessage):
+            return
+        try:
+            device, rssi = msg.channelID, msg.rssi
+        except MessageError:
+            return
+        if device is None:
+            device = self._channelDevice(msg.channelNumber)
+            if device is None:
+                return
+        self.seen(device, msg.data, None if rssi is None else rssi[1])
+    
+    def _channelDevice(self, number):
+        node = self.node
+        if node is None or number >= len(node.channels):
+            return None
+        device = node.channels[number].device
+        if device is None or not device.number:
+            return None  # wildcard, could be anyone
+        return (device.number, device.type, device.transmissionType)
+    
+    def seen(self, device, data, rssi=None, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            slot = self._slots.get(device)
+            if slot is None:
+                if not self._free:
+                    self._grow(len(self._keys))
+                slot = self._free.pop()
+                self._slots[device] = slot
+                self._keys[slot] = device
+                self._firstSeen[slot] = now
+                self._intervals[slot] = 0.0
+                self._counts[slot] = 0
+                self._rssi[slot] = self.NO_RSSI
+            else:
+                interval = now - self._lastSeen[slot]
+                average = self._intervals[slot]
+                self._intervals[slot] = average + self.SMOOTHING * (interval - average) \
+                                        if average else interval
+            
+            self._lastSeen[slot] = now
+            self._counts[slot] += 1
+            if rssi is not None:
+                self._rssi[slot] = rssi
+            data = bytearray(data[:8])
+            self._payloads[slot * 8:slot * 8 + 8] = data + bytearray(8 - len(data))
+            
+            if now - self._expired >= self.timeout / 2:
+                self._expire(now)
+    
+    def expire(self, now=None):
+        # forget idle devices, returns their IDs
+        with self.lock:
+            return self._expire(time() if now is None else now)
+    
+    def _expire(self, now):
+        self._expired = now
+        deadline, lastSeen = now - self.timeout, self._lastSeen
+        expired = [device for device, slot in self._slots.items()
+                   if lastSeen[slot] < deadline]
+        for device in expired:
+            slot = self._slots.pop(device)
+            self._keys[slot] = None
+            self._free.append(slot)
+        return expired
+    
+    def get(self, device):
+        with self.lock:
+            slot = self._slots.get(tuple(device))
+            if slot is None:
+                return None
+            number, type_, transmissionType = self._keys[slot]
+            interval, rssi = self._intervals[slot], self._rssi[slot]
+            return DeviceState(number, type_, transmissionType,
+                               self._firstSeen[slot], self._lastSeen[slot],
+                               self._counts[slot],
+                               1 / interval if interval else 0.0,
+                               None if rssi == self.NO_RSSI else rssi,
+                               bytes(self._payloads[slot * 8:slot * 8 + 8]))
+    
+    def devices(self):
+        with self.lock:
+            return list(self._slots)
+    
+    def __len__(self):
+        return len(self._slots)
+    
+    def __contains__(self, device):
+        return tuple(device) in self._slots
+
+
+Coverage = namedtuple('Coverage', 'turns found messages lastHeard tracked coverage')
+
+
+class _Target(object):
+    def __init__(self, device, priority, added):
+        self.device = device
+        self.priority = priority
+        self.added = added
+        self.channel = None
+        self.lastHeard = None
+        self.heardSince = None
+        self.turns = 0
+        self.found = 0
+        self.messages = 0
+        self.tracked = 0.0
+
+
+class ChannelScheduler(object):
+    # Time-slices a pool of assigned receive channels among more devices than
+    # there are channels. A channel stays with a device for `dwell` seconds
+    # after finding it, or until its (short) search times out; it then goes
+    # to the waiting device with the highest priority times staleness
+    # (seconds since it was last heard, or added). step() does one round,
+    # start() runs a round every `interval` seconds in the background.
+    DWELL = 2.0
+    INTERVAL = 0.25
+    SEARCH_TIMEOUT = 1  # in 2.5 second counts
+    
+    SEARCHING = 'searching'
+    TRACKING = 'tracking'
+    CLOSED = 'closed'
+    
+    def __init__(self, channels, dwell=DWELL, searchTimeout=SEARCH_TIMEOUT,
+                 interval=INTERVAL, lowPrioritySearchTimeout=None):
+        self.channels = list(channels)
+        self.dwell = dwell
+        self.searchTimeout = searchTimeout
+        # searching with low priority first spares the channels tracking
+        self.lowPrioritySearchTimeout = lowPrioritySearchTimeout
+        self.interval = interval
+        self.lock = Lock()
+        self.running = False
+        self.runningLock = Lock()
+        self._thread = None
+        self._targets = {}
+        self._states = dict((channel, self.CLOSED) for channel in self.channels)
+        self._owners = dict((channel, None) for channel in self.channels)
+        # channels handed to an owner that is not set up on them yet: what
+        # they receive meanwhile is still the last owner's
+        self._pending = set()
+        for channel in self.channels:
+            channel.registerCallback(self)
+    
+    @staticmethod
+    def _key(device):
+        if isinstance(device, Device):
+            return (device.number, device.type, device.transmissionType)
+        return tuple(device)
+    
+    def addDevice(self, device, priority=1):
+        key = self._key(device)
+        with self.lock:
+            target = self._targets.get(key)
+            if target is None:
+                self._targets[key] = _Target(key, priority, time())
+            else:
+                target.priority = priority
+    
+    def removeDevice(self, device):
+        # the device's channel, if any, is handed over at the next round
+        with self.lock:
+            target = self._targets.pop(self._key(device), None)
+            if target is not None and target.channel is not None:
+                self._owners[target.channel] = None
+    
+    def process(self, msg, channel):
+        now = time()
+        with self.lock:
+            target = self._owners.get(channel)
+            if channel in self._pending:
+                target = None
+            if isinstance(msg, ChannelDataMessage):
+                self._states[channel] = self.TRACKING
+                if target is not None:
+                    target.lastHeard = now
+                    target.messages += 1
+                    if target.heardSince is None:
+                        target.heardSince = now
+                        target.found += 1
+            elif isinstance(msg, ChannelEventResponseMessage) and msg.messageID == 1:
+                code = msg.messageCode
+                if code == EVENT_CHANNEL_CLOSED:
+                    self._states[channel] = self.CLOSED
+                elif code in (EVENT_RX_SEARCH_TIMEOUT, EVENT_RX_FAIL_GO_TO_SEARCH):
+                    self._states[channel] = self.SEARCHING
+                    if target is not None:
+                        self._lost(target, now)
+    
+    @staticmethod
+    def _lost(target, now):
+        if target.heardSince is not None:
+            target.tracked += now - target.heardSince
+            target.heardSince = None
+    
+    def _score(self, target, now):
+        last = target.lastHeard if target.lastHeard is not None else target.added
+        return target.priority * (now - last + self.interval)
+    
+    def step(self, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            waiting = [target for target in self._targets.values()
+                       if target.channel is None]
+            free = []
+            for channel in self.channels:
+                state, target = self._states[channel], self._owners[channel]
+                if target is None or state == self.CLOSED or \
+                   (waiting and state == self.TRACKING and
+                    target.heardSince is not None and  # may be the last owner's state
+                    now - target.heardSince >= self.dwell):
+                    free.append((channel, state))
+                else:
+                    continue
+                if target is not None:
+                    self._lost(target, now)
+                    target.channel = None
+                    self._owners[channel] = None
+            
+            chosen = nlargest(len(free), waiting,
+                              key=lambda target: self._score(target, now))
+            chosen += [None] * (len(free) - len(chosen))
+            for (channel, _), target in zip(free, chosen):
+                if target is not None:
+                    target.channel = channel
+                    target.turns += 1
+                    self._owners[channel] = target
+                    self._pending.add(channel)
+        
+        # channel commands wait for the stick, so they are sent unlocked
+        for (channel, state), target in zip(free, chosen):
+            if state != self.CLOSED:
+                self._close(channel)
+            if target is not None:
+                self._open(channel, target.device)
+    
+    def _close(self, channel):
+        try:
+            channel.close()
+        except ChannelError:
+            pass  # closed by a search timeout meanwhile
+        with self.lock:
+            self._states[channel] = self.CLOSED
+    
+    def _open(self, channel, device):
+        number, type_, transmissionType = device
+        with self.lock:
+            self._states[channel] = self.SEARCHING
+        if channel.searchTimeout != self.searchTimeout:
+            channel.searchTimeout = self.searchTimeout
+        lowPriority = self.lowPrioritySearchTimeout
+        if lowPriority is not None and channel.lowPrioritySearchTimeout != lowPriority:
+            channel.lowPrioritySearchTimeout = lowPriority
+        channel.setID(type_, number, transmissionType)
+        with self.lock:
+            self._pending.discard(channel)
+        channel.open()
+    
+    def coverage(self, now=None):
+        # Coverage per device: turns given, turns it was found in, messages
+        # received, when it was last heard, seconds tracked and the share of
+        # the time since it was added that it was tracked.
+        now = time() if now is None else now
+        with self.lock:
+            metrics = {}
+            for key, target in self._targets.items():
+                tracked = target.tracked
+                if target.heardSince is not None:
+                    tracked += now - target.heardSince
+                elapsed = now - target.added
+                metrics[key] = Coverage(target.turns, target.found, target.messages,
+                                        target.lastHeard, tracked,
+                                        tracked / elapsed if elapsed > 0 else 0.0)
+            return metrics
+    
+    def start(self):
+        with self.runningLock:
+            if self.running:
+                return
+            self.running = True
+            thread = self._thread = Thread(target=self._run, name='ChannelScheduler')
+            thread.daemon = True
+            thread.start()
+    
+    def stop(self):
+        with self.runningLock:
+            if not self.running:
+                return
+            self.running = False
+        self._thread.join()
+    
+    def _run(self):
+        while True:
+            with self.runningLock:
+                if not self.running:
+                    break
+            try:
+                self.step()
+            except Exception as err:  # pylint: disable=broad-except
+                print(err)  # keep scheduling, the next round may do better
+            sleep(self.interval)
+
+
+class ChannelAllocator(object):
+    # Hands out the channels of one or more nodes. Each node's free channels
+    # are the set bits of an integer, so taking the lowest one and giving it
+    # back are a few integer operations under a lock. Channels sharing an
+    # `affinity` key (say, every channel of a shared-channel network) are
+    # kept on the same node while any of them is in use.
+    def __init__(self):
+        self.lock = Lock()
+        self._nodes = []
+        self._free = {}
+        self._counts = {}
+        self._affinity = {}
+        self._keys = {}
+    
+    def addNode(self, node):
+        # (re)register `node`, all its channels start free
+        with self.lock:
+            if node not in self._free:
+                self._nodes.append(node)
+            self._free[node] = (1 << len(node.channels)) - 1
+            self._counts[node] = len(node.channels)
+            for channel, key in list(self._keys.items()):
+                if channel.node is node:
+                    self._unbind(channel, key)
+    
+    def removeNode(self, node):
+        with self.lock:
+            if node not in self._free:
+                return
+            self._nodes.remove(node)
+            del self._free[node], self._counts[node]
+            for channel, key in list(self._keys.items()):
+                if channel.node is node:
+                    self._unbind(channel, key)
+    
+    def acquire(self, node=None, affinity=None):
+        # Take a free channel, of `node` if given, otherwise of the node
+        # `affinity` is bound to, or else of the node with the most free
+        # channels.
+        with self.lock:
+            bound = self._affinity.get(affinity) if affinity is not None else None
+            if bound is not None:
+                if node is not None and node is not bound[0]:
+                    raise NodeError('Could not find free channel (affinity '
+                                    'bound to another node).')
+                node = bound[0]
+            elif node is None:
+                counts = self._counts
+                node = max(self._nodes, key=counts.get) if self._nodes else None
+            
+            free = self._free.get(node, 0)
+            if not free:
+                raise NodeError('Could not find free channel.')
+            lowest = free & -free
+            self._free[node] = free ^ lowest
+            self._counts[node] -= 1
+            
+            channel = node.channels[lowest.bit_length() - 1]
+            if affinity is not None:
+                if bound is None:
+                    bound = self._affinity[affinity] = [node, 0]
+                bound[1] += 1
+                self._keys[channel] = affinity
+            return channel
+    
+    def reserve(self, channel):
+        # mark `channel` as taken, returns whether it was free
+        with self.lock:
+            node, bit = channel.node, 1 << channel.number
+            free = self._free.get(node, 0)
+            if not free & bit:
+                return False
+            self._free[node] = free ^ bit
+            self._counts[node] -= 1
+            return True
+    
+    def release(self, channel):
+        with self.lock:
+            node, bit = channel.node, 1 << channel.number
+            free = self._free.get(node)
+            if free is None or free & bit:
+                return
+            self._free[node] = free | bit
+            self._counts[node] += 1
+            key = self._keys.get(channel)
+            if key is not None:
+                self._unbind(channel, key)
+    
+    def _unbind(self, channel, key):
+        del self._keys[channel]
+        bound = self._affinity[key]
+        bound[1] -= 1
+        if not bound[1]:
+            del self._affinity[key]
+    
+    def available(self, node=None):
+        # number of free channels, of `node` or of every node
+        with self.lock:
+            if node is not None:
+                return self._counts.get(node, 0)
+            return sum(self._counts.values())
+
+
+class Reconnector(object):
+    # The event machine's recovery when the device is lost (a USBError or
+    # DriverError from the pump): the driver is reopened, waiting `backoff`
+    # seconds between attempts, doubled each time up to `maxBackoff`, for
+    # `retries` attempts or, with None, for as long as the machine runs.
+    # Once reopened, the pump carries on and the node's state is replayed
+    # from another thread, as that waits on the pump. Callbacks are handed a
+    # ConnectionEvent as the device is LOST and then RECOVERED (or FAILED).
+    def __init__(self, node, retries=None, backoff=0.05, maxBackoff=1.0):
+        self.node = node
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.recoveries = 0
+    
+    def _notify(self, state, error, start):
+        self.node.evm.notify(event.ConnectionEvent(state, error, time() - start))
+    
+    def __call__(self, err):
+        evm, start = self.node.evm, time()
+        self._notify(event.ConnectionEvent.LOST, err, start)
+        
+        delay, attempts = self.backoff, 0
+        while True:
+            with evm.runningLock:
+                if not evm.running:
+                    return False
+            try:
+                evm.driver.reopen()
+                break
+            except Exception as error:  # pylint: disable=broad-except
+                attempts += 1
+                if self.retries is not None and attempts >= self.retries:
+                    self._notify(event.ConnectionEvent.FAILED, error, start)
+                    return False
+            sleep(delay)
+            delay = min(delay * 2, self.maxBackoff)
+        
+        replayer = Thread(target=self._replay, args=(start,), name='Replay')
+        replayer.daemon = True
+        replayer.start()
+        return True
+    
+    def _replay(self, start):
+        try:
+            self.node.replay()
+        except (NodeError, DriverError, USBError) as err:  # lost again, say
+            self._notify(event.ConnectionEvent.FAILED, err, start)
+        else:
+            self.recoveries += 1
+            self._notify(event.ConnectionEvent.RECOVERED, None, start)
+
+
 class Node(object):
-    def __init__(self, driver):
-        self.evm = event.EventMachine(driver)
+    def __init__(self, driver, capture=None, allocator=None):
+        self.evm = event.EventMachine(driver, capture)
         self.networks = []
         self.channels = []
         self.options = [0x00, 0x00, 0x00]
+        self.libConfig = 0x00
+        # shared by nodes whose channels are handed out together
+        self.allocator = allocator if allocator is not None else ChannelAllocator()
     
     running = property(lambda self: self.evm.running)
     
@@ -215,11 +1260,14 @@ class Node(object):
             self.networks = [ None ] * caps.maxNetworks
             self.channels = [ Channel(self, i) for i in xrange(0, caps.maxChannels) ]
             self.options = (caps.stdOptions, caps.advOptions, caps.advOptions2)
+            self.libConfig = 0x00
+            self.allocator.addNode(self)
 
     def stop(self):
         if not self.running:
             raise NodeError('Could not stop ANT node (not started).')
         
+        self.allocator.removeNode(self)
         self.reset(wait=False)
         self.evm.stop()
     
@@ -240,11 +1288,88 @@ class Node(object):
         
         network.number = number
     
-    def getFreeChannel(self):
+    def setLibConfig(self, config):
+        # LIB_CONFIG_* flags, the extended data added to received messages
+        msg = message.LibConfigMessage(config)
+        try:
+            self.evm.writeMessage(msg).waitForAck(msg)
+        except MessageError as err:
+            raise NodeError('could not set lib config: %s' % err)
+        
+        self.libConfig = config
+    
+    def enableExtendedMessages(self, channelID=True, rssi=False, rxTimestamp=False):
+        # have received data messages carry the given extended fields, see
+        # message.ChannelDataMessage
+        config = 0x00
+        if channelID:
+            config |= LIB_CONFIG_CHANNEL_ID
+        if rssi:
+            config |= LIB_CONFIG_RSSI
+        if rxTimestamp:
+            config |= LIB_CONFIG_RX_TIMESTAMP
+        self.setLibConfig(config)
+    
+    def closeAll(self):
+        # close every open channel at once, each waits for its own event
+        errors = []
+        def close(channel):
+            try:
+                channel.close()
+            except ChannelError as err:
+                errors.append(err)
+        
+        closers = [Thread(target=close, args=(channel,)) for channel in self.channels
+                   if channel.opened]
+        for closer in closers:
+            closer.start()
+        for closer in closers:
+            closer.join()
+        if errors:
+            raise NodeError('could not close all channels: %s' %
+                            '; '.join(str(err) for err in errors))
+    
+    def replay(self):
+        # Reset the stick and bring it back to the node's state: lib config,
+        # network keys, then every assigned channel's configuration, opening
+        # those that were open. Commands are written a stick buffer full at
+        # a time, each batch acknowledged before the next. Transfers in
+        # flight are failed: the reset drops them, their events never come.
+        for channel in self.channels:
+            transfers = channel._transfers  # pylint: disable=protected-access
+            if transfers is not None:
+                transfers.cancel(ChannelError('%s: device reset' % channel))
+        
+        messages = []
+        if self.libConfig:
+            messages.append(message.LibConfigMessage(self.libConfig))
+        for number, network in enumerate(self.networks):
+            if network is not None:
+                messages.append(message.NetworkKeyMessage(number, network.key))
         for channel in self.channels:
-            if channel.network is None:
-                return channel
-        raise NodeError('Could not find free channel.')
+            messages.extend(channel.replayMessages())
+        
+        evm = self.evm
+        size = evm.scheduler.credits
+        try:
+            self.reset()
+            for first in range(0, len(messages), size):
+                batch = messages[first:first + size]
+                evm.writeMessage(event.MessageBatch(batch))
+                for msg in batch:
+                    evm.waitForAck(msg)
+        except MessageError as err:
+            raise NodeError('could not replay state: %s' % err)
+    
+    def enableRecovery(self, retries=None, backoff=0.05, maxBackoff=1.0):
+        # reopen the device and replay the node's state when it is lost, see
+        # Reconnector
+        self.evm.recovery = recovery = Reconnector(self, retries, backoff, maxBackoff)
+        return recovery
+    
+    def getFreeChannel(self, affinity=None):
+        # the channel is taken until unassigned (or released to the allocator)
+        return self.allocator.acquire(self, affinity)
     
     def registerEventListener(self, callback):
         self.evm.registerCallback(callback)
@@ -28,7 +28,9 @@ from __future__ import division, absolute_import, print_function, unicode_litera
 
 import unittest
 
-from ant.core.driver import Driver
+from serial import SerialException
+
+from ant.core.driver import Driver, USB1Driver
 from ant.core.exceptions import DriverError
 
 
@@ -98,3 +100,13 @@ class USB1DriverTest(unittest.TestCase):
 
     def _write(self):
         pass
+
+    def test_unplugged(self):
+        class Unplugged(object):
+            def read(self, count):
+                raise SerialException('device disconnected')
+            write = read
+        driver = USB1Driver('/dev/null')
+        driver._serial = Unplugged()
+        self.assertRaises(DriverError, driver.read, 1)
+        self.assertRaises(DriverError, driver._write, b'\xA4')
@@ -25,8 +25,129 @@
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
-#import unittest
+import unittest
+from threading import Thread, current_thread
+from time import sleep, time
 
-#from ant.core.event import *
+from ant.core.constants import EVENT_CHANNEL_CLOSED, EVENT_TX, EVENT_SERIAL_QUE_OVERFLOW
+from ant.core.event import (AckCallback, ChannelEventCallback, MessageFrame, MessageBatch,
+                            OutboundScheduler, EventMachine)
+from ant.core.exceptions import MessageError
+from ant.core.message import (ChannelEventResponseMessage, ChannelCloseMessage,
+                              ChannelBroadcastDataMessage)
 
-# How exactly do you properly test threaded code?
+
+def event(channel, code):
+    return ChannelEventResponseMessage(channel, 1, code)
+
+
+class ChannelEventCallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.events = ChannelEventCallback()
+
+    def test_waitFor(self):
+        events = self.events
+        waiter = events.expect(1, EVENT_CHANNEL_CLOSED)
+        events.process(event(0, EVENT_CHANNEL_CLOSED))
+        events.process(event(1, EVENT_TX))
+        self.assertFalse(waiter.event.is_set())
+        closed = event(1, EVENT_CHANNEL_CLOSED)
+        events.process(closed)
+        self.assertTrue(events.waitFor(waiter, timeout=0) is closed)
+        self.assertEquals(events.waiters, {})
+
+    def test_threads(self):
+        events, received = self.events, {}
+        waiters = [events.expect(channel, EVENT_CHANNEL_CLOSED) for channel in range(8)]
+        def wait(waiter):
+            received[waiter.key[0]] = events.waitFor(waiter, timeout=5).channelNumber
+        threads = [Thread(target=wait, args=(waiter,)) for waiter in waiters]
+        for thread in threads:
+            thread.start()
+        for channel in reversed(range(8)):
+            events.process(event(channel, EVENT_CHANNEL_CLOSED))
+        for thread in threads:
+            thread.join()
+        self.assertEquals(received, dict((channel, channel) for channel in range(8)))
+
+    def test_timeout(self):
+        waiter = self.events.expect(1, EVENT_CHANNEL_CLOSED)
+        self.assertRaises(MessageError, self.events.waitFor, waiter, 0.01)
+        self.assertEquals(self.events.waiters, {})
+
+
+class AckCallbackTest(unittest.TestCase):
+    def test_channel(self):
+        ack = AckCallback()
+        for channel in (2, 1):
+            ack.process(ChannelEventResponseMessage(channel, ChannelCloseMessage.type, 0))
+        self.assertEquals(ack.waitFor(ChannelCloseMessage(1), timeout=0.1).channelNumber, 1)
+        self.assertEquals(ack.waitFor(ChannelCloseMessage(2), timeout=0.1).channelNumber, 2)
+
+
+class MessageFrameTest(unittest.TestCase):
+    def test_update(self):
+        frame = MessageFrame(ChannelBroadcastDataMessage(5, bytearray(8)))
+        raw = frame.encode()
+        for data in (bytearray(range(8)), b'\xFF' * 8):
+            frame.update(data)
+            self.assertTrue(frame.encode() is raw)
+            self.assertEquals(raw, ChannelBroadcastDataMessage(5, data).encode())
+        self.assertRaises(MessageError, frame.update, b'\x00' * 7)
+        self.assertRaises(MessageError, MessageFrame, ChannelCloseMessage(1))
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = OutboundScheduler(credits=1, rate=10.0, minRate=1.0)
+
+    def test_priority(self):
+        scheduler = self.scheduler
+        data = ChannelBroadcastDataMessage(1, bytearray(8))
+        self.assertEquals(scheduler.priority(data), scheduler.DATA)
+        self.assertEquals(scheduler.priority(MessageFrame(data)), scheduler.DATA)
+        self.assertEquals(scheduler.priority(MessageBatch([data])), scheduler.DATA)
+        self.assertEquals(scheduler.priority(ChannelCloseMessage(1)), scheduler.CONTROL)
+        self.assertEquals(scheduler.priority(MessageBatch([ChannelCloseMessage(1), data])),
+                          scheduler.CONTROL)
+
+    def test_pump(self):
+        # writes from the event pump's callbacks go into debt instead of waiting
+        written = []
+        class Driver(object):
+            def write(self, msg):
+                written.append(msg)
+        evm = EventMachine(Driver(), scheduler=OutboundScheduler(credits=1, rate=1.0))
+        evm.eventPump = current_thread()
+        basetime = time()
+        for _ in range(3):
+            evm.writeMessage(ChannelCloseMessage(1))
+        self.assertTrue(time() - basetime < 0.5)
+        self.assertEquals(len(written), 3)
+        self.assertTrue(evm.scheduler._available < 0)
+
+    def test_control_first(self):
+        scheduler, order = self.scheduler, []
+        scheduler.acquire(scheduler.CONTROL)  # no credits left
+        def write(priority):
+            scheduler.acquire(priority)
+            order.append(priority)
+        threads = [Thread(target=write, args=(priority,))
+                   for priority in (scheduler.DATA, scheduler.CONTROL)]
+        for thread in threads:
+            thread.start()
+            sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEquals(order, [scheduler.CONTROL, scheduler.DATA])
+
+    def test_overflow(self):
+        scheduler = self.scheduler
+        scheduler.process(event(0, EVENT_SERIAL_QUE_OVERFLOW))
+        scheduler.process(event(0, EVENT_TX))
+        self.assertEquals(scheduler.overflows, 1)
+        self.assertEquals(scheduler.rate, 5.0)
+        scheduler.RECOVERY = 100.0
+        sleep(0.25)  # credit back at 5/s, then the rate recovers
+        scheduler.acquire(scheduler.DATA)
+        self.assertEquals(scheduler.rate, 10.0)
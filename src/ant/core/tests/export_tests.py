@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring, invalid-name
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+LOG_LOCATION = '/tmp/python-ant.exporttest.ant'
+
+import unittest
+
+import numpy
+
+from ant.core import message
+from ant.core.export import toArrays, saveArrays
+from ant.core.log import LogWriter, LogReader, EVENT_READ, EVENT_WRITE, decodeEvents
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        lw = LogWriter(LOG_LOCATION)
+        lw.logWrite(message.ChannelIDMessage(2, 0x1234, 120, 1).encode())
+        for i in range(10):
+            raw = message.ChannelBroadcastDataMessage(2, bytearray(range(i, i + 8))).encode()
+            lw.logRead(raw[:6])
+            lw.logRead(raw[6:])
+        bad = message.ChannelBroadcastDataMessage(3).encode()
+        bad[-1] ^= 0xFF
+        lw.logRead(bad)
+        lw.logRead(message.StartupMessage(0x20).encode())
+        lw.close()
+
+    def check(self, arrays):
+        self.assertEquals(len(arrays['timestamp']), 13)
+        self.assertTrue((numpy.diff(arrays['timestamp']) >= 0).all())
+        self.assertEquals(arrays['direction'].tolist(),
+                          [EVENT_WRITE] + [EVENT_READ] * 12)
+        self.assertEquals(arrays['channel'].tolist(), [2] * 11 + [3, -1])
+        self.assertEquals(arrays['valid'].tolist(), [True] * 11 + [False, True])
+        self.assertEquals(arrays['data'][0].tolist(), [0x34, 0x12, 120, 1, 0, 0, 0, 0])
+        self.assertEquals(arrays['data'][5].tolist(), list(range(4, 12)))
+        self.assertEquals(arrays['data'][12].tolist(), [0x20, 0, 0, 0, 0, 0, 0, 0])
+
+    def test_toArrays(self):
+        self.check(toArrays(LOG_LOCATION))
+
+    def test_chunks(self):
+        self.check(toArrays(LOG_LOCATION, chunkSize=7))
+
+    def test_save(self):
+        saveArrays(LOG_LOCATION, LOG_LOCATION + '.npz')
+        self.check(numpy.load(LOG_LOCATION + '.npz'))
+
+    def test_messages(self):
+        lw = LogWriter(LOG_LOCATION)
+        lw.logMessageWrite(message.ChannelIDMessage(2, 0x1234, 120, 1))
+        for i in range(10):
+            lw.logRead(message.ChannelBroadcastDataMessage(2, bytearray(range(i, i + 8))).encode())
+        bad = message.ChannelBroadcastDataMessage(3).encode()
+        bad[-1] ^= 0xFF
+        lw.logRead(bad)
+        lw.logMessageRead(message.StartupMessage(0x20))
+        lw.close()
+        self.check(toArrays(LOG_LOCATION))
+
+    def test_noise(self):
+        lw = LogWriter(LOG_LOCATION)
+        lw.logRead(b'\xA4\xFF')  # a sync byte claiming more than is left
+        for i in range(5):
+            lw.logRead(message.ChannelBroadcastDataMessage(2, bytearray(range(i, i + 8))).encode())
+        lw.close()
+
+        arrays = toArrays(LOG_LOCATION)
+        self.assertEquals(arrays['valid'].tolist(), [True] * 5)
+        self.assertEquals(arrays['data'][:, 0].tolist(), list(range(5)))
+        self.assertEquals(len(list(decodeEvents(LogReader(LOG_LOCATION)))), 5)
@@ -29,9 +29,17 @@ from __future__ import division, absolute_import, print_function, unicode_litera
 LOG_LOCATION = '/tmp/python-ant.logtest.ant'
 
 import unittest
+import zlib
+from threading import Event, Thread
 
-from ant.core.log import (LogReader, LogWriter,
-                          EVENT_OPEN, EVENT_CLOSE, EVENT_READ, EVENT_WRITE)
+import msgpack
+
+from ant.core import message
+from ant.core.log import (LogReader, LogWriter, AsyncLogWriter, CODECS,
+                          MappedLogReader,
+                          EVENT_OPEN, EVENT_CLOSE, EVENT_READ, EVENT_WRITE,
+                          EVENT_MESSAGE_READ, EVENT_MESSAGE_WRITE, decodeEvents, decodeLogs, mergeLogs,
+                          frameEvents, _frameEvents, numpy)
 
 
 class LogReaderTest(unittest.TestCase):
@@ -83,6 +91,359 @@ class LogReaderTest(unittest.TestCase):
         self.assertTrue(isinstance(t1[1], int))
         self.assertEquals(len(t5), 2)
 
+    def test_iter(self):
+        self.assertEquals([event[0] for event in self.log],
+                          [EVENT_OPEN, EVENT_READ, EVENT_WRITE, EVENT_READ,
+                           EVENT_CLOSE])
+
+    def test_stream(self):
+        lw = LogWriter(LOG_LOCATION)
+        for i in range(1000):
+            lw.logRead(b'%04d' % i)
+        lw.close()
+
+        log = LogReader(LOG_LOCATION, chunkSize=7)
+        self.assertEquals([event[2] for event in log],
+                          [b'%04d' % i for i in range(1000)])
+
+    def test_timestamps(self):
+        lw = LogWriter(LOG_LOCATION, stick='stick-1')
+        for _ in range(100):
+            lw.logRead(b'\x00')
+        lw.close()
+
+        log = LogReader(LOG_LOCATION)
+        self.assertEquals(log.version, 2)
+        self.assertEquals(log.stick, b'stick-1')
+        self.assertEquals(log.timescale, 1000000000)
+        stamps = [event[1] for event in log]
+        self.assertEquals(stamps, sorted(stamps))
+        self.assertTrue(stamps[0] >= log.startTime)
+        self.assertTrue(len(set(stamps)) > 1)
+
+    def test_clock_stepped_back(self):
+        lw = LogWriter(LOG_LOCATION)
+        base = lw._last
+        for timestamp in (base + 10, base - 1000, base - 990):
+            lw.fd.write(lw._pack(EVENT_READ, timestamp, b'\x00'))
+        lw.close()
+
+        stamps = [event[1] for event in LogReader(LOG_LOCATION)]
+        self.assertEquals([stamp - stamps[0] for stamp in stamps], [0, 0, 10])
+
+    def test_version1(self):
+        packer = msgpack.Packer()
+        with open(LOG_LOCATION, 'wb') as fd:
+            fd.write(packer.pack(['ANT-LOG', 0x01]))
+            fd.write(packer.pack([EVENT_OPEN, 1300000000]))
+            fd.write(packer.pack([EVENT_READ, 1300000001, b'\xA4']))
+
+        log = LogReader(LOG_LOCATION)
+        self.assertEquals(log.version, 1)
+        self.assertEquals(log.timescale, 1)
+        self.assertEquals(log.read(), [EVENT_OPEN, 1300000000])
+        self.assertEquals(log.read(), [EVENT_READ, 1300000001, b'\xA4'])
+        self.assertEquals(log.read(), None)
+
+
+class IndexedLogTest(unittest.TestCase):
+    def setUp(self):
+        setID = message.ChannelIDMessage(1, 0x1234, 120, 1).encode()
+        data0 = message.ChannelBroadcastDataMessage(0, b'\x00' * 8).encode()
+        data1 = message.ChannelBroadcastDataMessage(1, b'\x01' * 8).encode()
+
+        lw = LogWriter(LOG_LOCATION, index=True)
+        lw.index.interval = 0  # a block for every frame boundary
+        lw.logWrite(setID)
+        lw.logRead(data0)
+        lw.logRead(data1[:5])
+        lw.logRead(data1[5:])
+        lw.logRead(data0)
+        lw.close()
+
+        self.log = LogReader(LOG_LOCATION)
+        self.events = list(self.log)
+
+    def test_index(self):
+        index = self.log.index
+        self.assertEquals(len(index.blocks), 4)
+        self.assertEquals(index.channels, {0: [1, 3], 1: [0, 2]})
+        self.assertEquals(index.devices, {(0x1234, 120, 1): [0, 2]})
+
+    def test_seek(self):
+        events = self.events
+        self.log.seek(events[3][1])
+        self.assertEquals(self.log.read(), events[3])
+        self.log.seek(events[0][1])
+        self.assertEquals(list(self.log), events)
+
+    def test_iter(self):
+        events = self.events
+        self.assertEquals(list(self.log.iter(channel=1)),
+                          [events[0], events[2], events[3]])
+        self.assertEquals(list(self.log.iter(device=(0x1234, 120, 1),
+                                             start=events[1][1])),
+                          events[2:4])
+        self.assertEquals(list(self.log.iter(start=events[1][1],
+                                             end=events[4][1])),
+                          events[1:4])
+
+    def test_noise(self):
+        data = message.ChannelBroadcastDataMessage(3, b'\x03' * 8).encode()
+        lw = LogWriter(LOG_LOCATION, index=True)
+        lw.index.interval = 0
+        lw.logRead(b'\xA4\x40')  # a sync byte with a bogus length
+        for _ in range(10):
+            lw.logRead(data)
+        lw.close()
+
+        log = LogReader(LOG_LOCATION)
+        records = [event for event in log.iter(channel=3) if event[2] == bytes(data)]
+        self.assertEquals(len(records), 10)
+
+    def test_stale(self):
+        LogWriter(LOG_LOCATION).close()
+        self.assertEquals(LogReader(LOG_LOCATION).index, None)
+        lw = LogWriter(LOG_LOCATION, index=True)
+        lw.close()
+        lw = LogWriter(LOG_LOCATION, index=True)
+        lw.logRead(b'\x00')
+        lw.fd.flush()
+        self.assertEquals(LogReader(LOG_LOCATION).index, None)
+        lw.close()
+        self.assertNotEquals(LogReader(LOG_LOCATION).index, None)
+
+
+class CompressedLogTest(unittest.TestCase):
+    def write(self, compression):
+        data = [message.ChannelBroadcastDataMessage(i % 8, bytearray(7) +
+                                                    bytearray([i % 256])).encode()
+                for i in range(2000)]
+        lw = LogWriter(LOG_LOCATION, index=True, compression=compression,
+                       blockSize=1024)
+        for frame in data:
+            lw.logRead(frame)
+        lw.close()
+        return data
+
+    def test_zlib(self):
+        data = self.write('zlib')
+        log = LogReader(LOG_LOCATION)
+        self.assertEquals(log.codec, b'zlib')
+        self.assertTrue(len(log.index.blocks) > 1)
+
+        events = list(log)
+        self.assertEquals([bytearray(event[2]) for event in events], data)
+        log.seek(events[1500][1])
+        self.assertEquals(log.read(), events[1500])
+        self.assertEquals(list(log.iter(start=events[10][1], end=events[20][1])),
+                          events[10:20])
+        onChannel = lambda event: bytearray(event[2])[3] == 3
+        self.assertEquals(list(filter(onChannel, log.iter(channel=3))),
+                          list(filter(onChannel, events)))
+
+    @unittest.skipIf('lzma' not in CODECS, 'lzma is not available')
+    def test_lzma(self):
+        data = self.write('lzma')
+        self.assertEquals([bytearray(event[2]) for event in LogReader(LOG_LOCATION)],
+                          data)
+
+    def test_crc(self):
+        self.write('zlib')
+        with open(LOG_LOCATION, 'r+b') as fd:
+            fd.seek(-2, 2)
+            fd.write(b'\xFF\xFF')
+        log = LogReader(LOG_LOCATION)
+        with self.assertRaises((IOError, zlib.error)):
+            list(log)
+
+
+class RotatingLogTest(unittest.TestCase):
+    def read(self, segments):
+        events = []
+        for segment in segments:
+            events.extend(LogReader(segment))
+        return events
+
+    def test_size(self):
+        lw = LogWriter(LOG_LOCATION, index=True, maxBytes=200)
+        for i in range(100):
+            lw.logRead(message.ChannelBroadcastDataMessage(i % 8).encode())
+        lw.close()
+
+        segments = lw.segments
+        self.assertTrue(len(segments) > 5)
+        self.assertEquals(segments[:2], [LOG_LOCATION,
+                                         LOG_LOCATION[:-4] + '.1.ant'])
+        self.assertEquals(LogReader(segments[1]).index.blocks[0][0] > 0, True)
+
+        events = self.read(segments)
+        self.assertEquals(len(events), 100)
+        stamps = [event[1] for event in events]
+        self.assertEquals(stamps, sorted(stamps))
+
+    def test_age(self):
+        lw = AsyncLogWriter(LOG_LOCATION, compression='zlib', maxAge=0)
+        for _ in range(10):
+            lw.logRead(b'\x00')
+        lw.close()
+
+        self.assertEquals(len(lw.segments), 11)
+        self.assertEquals(len(self.read(lw.segments)), 10)
+
+
+class DecodeTest(unittest.TestCase):
+    def setUp(self):
+        self.logs = []
+        for channel in range(2):
+            filename = LOG_LOCATION[:-4] + '.decode%d.ant' % channel
+            lw = LogWriter(filename, index=True)
+            lw.index.interval = 0
+            for i in range(20):
+                raw = message.ChannelBroadcastDataMessage(channel, bytearray(7) +
+                                                          bytearray([i])).encode()
+                lw.logRead(raw[:4])
+                lw.logRead(raw[4:] + b'\xFF')  # junk is skipped
+            lw.close()
+            self.logs.append(filename)
+
+    def test_decodeEvents(self):
+        decoded = list(decodeEvents(LogReader(self.logs[0])))
+        self.assertEquals(len(decoded), 20)
+        self.assertEquals([msg.payload[-1] for _, _, msg in decoded], list(range(20)))
+        self.assertTrue(all(direction == EVENT_READ for _, direction, _ in decoded))
+        self.assertTrue(isinstance(decoded[0][2], message.ChannelBroadcastDataMessage))
+
+    @unittest.skipIf(numpy is None, 'numpy is not available')
+    def test_batches(self):
+        raw = [bytes(message.ChannelBroadcastDataMessage(i % 2, bytearray([0xA4] * 8)).encode())
+               for i in range(6)]
+        events = [[EVENT_READ, 1, raw[0][:5]], [EVENT_WRITE, 2, raw[1]],
+                  [EVENT_READ, 3, raw[0][5:] + b'\xA4\x20'],  # noise waiting for bytes
+                  [EVENT_MESSAGE_READ, 4, 0x4E, 0, b'\x00' * 9],
+                  [EVENT_READ, 5, raw[2] + raw[3][:3]], [EVENT_WRITE, 6, b''],
+                  [EVENT_READ, 7, raw[3][3:] + b'\x00' * 30], [EVENT_READ, 8, raw[4]],
+                  [EVENT_WRITE, 9, b'\xA4' + raw[5]], [EVENT_READ, 10, b'\xA4\x09']]
+        framed = list(_frameEvents(events))
+        self.assertEquals(len(framed), 7)
+        for batchSize in (1, 2, 3, 100):
+            self.assertEquals(list(frameEvents(events, batchSize)), framed)
+
+    def test_decodeLogs(self):
+        decoded = decodeLogs(self.logs, processes=2, blocksPerTask=3)
+        self.assertEquals(len(decoded), 40)
+        stamps = [timestamp for timestamp, _, _ in decoded]
+        self.assertEquals(stamps, sorted(stamps))
+        for channel in range(2):
+            self.assertEquals([msg.payload[-1] for _, _, msg in decoded
+                               if msg.channelNumber == channel], list(range(20)))
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        lw = LogWriter(LOG_LOCATION, index=True)
+        lw.index.interval = 0
+        lw.logMessageWrite(message.ChannelIDMessage(1, 0x1234, 120, 1))
+        lw.logMessageRead(message.StartupMessage(0x20))
+        lw.logMessageRead(message.ChannelBroadcastDataMessage(1, b'\x01' * 8))
+        lw.logMessageRead(message.ChannelBroadcastDataMessage(0, b'\x00' * 8))
+        lw.close()
+        self.log = LogReader(LOG_LOCATION)
+
+    def test_records(self):
+        events = list(self.log)
+        self.assertEquals([event[0] for event in events],
+                          [EVENT_MESSAGE_WRITE] + [EVENT_MESSAGE_READ] * 3)
+        self.assertEquals(events[0][2:4], [message.ChannelIDMessage.type, 1])
+        self.assertEquals(events[1][2:], [message.StartupMessage.type, None, b'\x20'])
+        self.assertEquals(events[3][4], b'\x00' * 9)
+
+    def test_index(self):
+        index = self.log.index
+        self.assertEquals(index.channels, {0: [3], 1: [0, 2]})
+        self.assertEquals(index.devices, {(0x1234, 120, 1): [0, 2]})
+        self.assertEquals(index.types[message.StartupMessage.type], [1])
+        self.assertEquals(len(list(self.log.iter(type_=message.StartupMessage.type))), 1)
+
+    def test_decodeEvents(self):
+        decoded = list(decodeEvents(self.log))
+        self.assertEquals([direction for _, direction, _ in decoded],
+                          [EVENT_WRITE] + [EVENT_READ] * 3)
+        self.assertTrue(isinstance(decoded[1][2], message.StartupMessage))
+        self.assertEquals(decoded[2][2].channelNumber, 1)
+
+
+class MappedLogReaderTest(unittest.TestCase):
+    def write(self, **kwargs):
+        lw = LogWriter(LOG_LOCATION, **kwargs)
+        lw.logOpen()
+        for i in range(300):
+            lw.logRead(message.ChannelBroadcastDataMessage(i % 4, bytearray(8) * (i % 2)).encode())
+        lw.logClose()
+        lw.close()
+        return [[event[0], event[1]] + [bytes(data) for data in event[2:]]
+                for event in LogReader(LOG_LOCATION)]
+
+    def events(self, log):
+        return [[event[0], event[1]] + [bytes(bytearray(data)) for data in event[2:]]
+                for event in log]
+
+    def test_read(self):
+        expected = self.write()
+        log = MappedLogReader(LOG_LOCATION)
+        event = log.read()
+        event = log.read()
+        self.assertFalse(isinstance(event[2], bytes))
+        log.rewind()
+        self.assertEquals(self.events(log), expected)
+
+    def test_concurrent(self):
+        expected = self.write(index=True)
+        first, second = MappedLogReader(LOG_LOCATION), MappedLogReader(LOG_LOCATION)
+        first.seek(expected[150][1])
+        self.assertEquals(self.events(second), expected)
+        self.assertEquals(self.events(first), expected[150:])
+
+    def test_compressed(self):
+        expected = self.write(compression='zlib', blockSize=256)
+        log = MappedLogReader(LOG_LOCATION)
+        self.assertEquals(self.events(log), expected)
+
+    def test_truncated(self):
+        expected = self.write()
+        with open(LOG_LOCATION, 'r+b') as fd:
+            fd.seek(-3, 2)
+            fd.truncate()
+        self.assertEquals(self.events(MappedLogReader(LOG_LOCATION)), expected[:-1])
+
+
+class MergeTest(unittest.TestCase):
+    def test_merge(self):
+        logs = [LOG_LOCATION[:-4] + '.merge%d.ant' % i for i in range(3)]
+        writers = [LogWriter(logs[0], stick='A'), LogWriter(logs[1], stick='B'),
+                   LogWriter(logs[2])]
+        for i in range(30):
+            writers[i % 3].logRead(bytearray([i]))
+        for lw in writers:
+            lw.close()
+
+        merged = list(mergeLogs(logs))
+        # records written microseconds apart may share a timestamp, so only
+        # each source's order and the merged time order are certain
+        values = [bytearray(event[2])[0] for _, _, event in merged]
+        self.assertEquals(sorted(values), list(range(30)))
+        for i in range(3):
+            self.assertEquals([value for value in values if value % 3 == i],
+                              list(range(i, 30, 3)))
+        sources = dict((value, source) for value, (_, source, _) in zip(values, merged))
+        self.assertEquals([sources[i] for i in range(3)], [b'A', b'B', logs[2]])
+        stamps = [timestamp for timestamp, _, _ in merged]
+        self.assertEquals(stamps, sorted(stamps))
+
+        window = list(mergeLogs(logs, start=stamps[5], end=stamps[12]))
+        self.assertEquals(window, [event for event in merged
+                                   if stamps[5] <= event[0] < stamps[12]])
+
 
 class LogWriterTest(unittest.TestCase):
     def setUp(self):
@@ -99,3 +460,85 @@ class LogWriterTest(unittest.TestCase):
         # Redundant, any error in log* methods will cause the LogReader test
         # suite to fail.
         pass
+
+
+class StalledLogWriter(AsyncLogWriter):
+    def __init__(self, *args, **kwargs):
+        self.release = Event()
+        super(StalledLogWriter, self).__init__(*args, **kwargs)
+
+    def _run(self):
+        self.release.wait()
+        super(StalledLogWriter, self)._run()
+
+
+class FullDisk(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        raise IOError(28, 'No space left on device')
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+
+class FullDiskLogWriter(AsyncLogWriter):
+    def _run(self):
+        self.fd = FullDisk(self.fd)
+        super(FullDiskLogWriter, self)._run()
+
+
+class AsyncLogWriterTest(unittest.TestCase):
+    def test_log(self):
+        lw = AsyncLogWriter(LOG_LOCATION)
+        lw.logOpen()
+        lw.logRead('\x01')
+        lw.logWrite('\x00')
+        lw.logClose()
+        lw.close()
+        self.assertFalse(lw.is_open)
+
+        log = LogReader(LOG_LOCATION)
+        self.assertEquals([log.read()[0] for _ in range(4)],
+                          [EVENT_OPEN, EVENT_READ, EVENT_WRITE, EVENT_CLOSE])
+
+    def test_errors(self):
+        lw = FullDiskLogWriter(LOG_LOCATION, batchSize=1)
+        for _ in range(3):
+            lw.logRead('\x01')
+            lw.flush()
+        lw.close()
+        self.assertEquals(lw.errors, 3)
+
+    def test_rotation_errors(self):
+        lw = FullDiskLogWriter(LOG_LOCATION, batchSize=1, compression='zlib',
+                               blockSize=1, maxBytes=1)
+        for _ in range(3):
+            lw.logRead(b'\x01')
+        flusher = Thread(target=lw.flush)
+        flusher.daemon = True
+        flusher.start()
+        flusher.join(5)
+        self.assertFalse(flusher.is_alive())
+        self.assertTrue(lw._writer.is_alive())
+        self.assertTrue(lw.errors > 0)
+        lw.close()
+
+    def test_overflow(self):
+        lw = StalledLogWriter(LOG_LOCATION, queueSize=2)
+        lw.logOpen()
+        lw.logRead('\x01')
+        lw.logRead('\x02')
+        lw.logRead('\x03')
+        self.assertEquals(lw.dropped, 2)
+        self.assertEquals(lw.overflows, 1)
+        lw.release.set()
+        lw.close()
+
+        log = LogReader(LOG_LOCATION)
+        self.assertEquals(log.read()[0], EVENT_OPEN)
+        self.assertEquals(log.read()[2], '\x01')
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=missing-docstring, invalid-name
+##############################################################################
+#
+# Copyright (c) 2011, Martín Raúl Villalba
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+##############################################################################
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+LOG_LOCATION = '/tmp/python-ant.logtooltest.ant'
+
+import io
+import sys
+import unittest
+
+from ant.core import message
+from ant.core.log import LogWriter
+from ant.core.logtool import main
+
+
+class LogToolTest(unittest.TestCase):
+    def setUp(self):
+        lw = LogWriter(LOG_LOCATION, index=True)
+        lw.logWrite(message.ChannelIDMessage(1, 0x1234, 120, 1).encode())
+        for i in range(4):
+            lw.logRead(message.ChannelBroadcastDataMessage(i % 2, bytearray(7) +
+                                                           bytearray([i])).encode())
+        lw.close()
+
+    def run_main(self, *args):
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            self.assertEquals(main(list(args) + [LOG_LOCATION]), 0)
+            return sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+
+    def test_decoded(self):
+        lines = self.run_main()
+        self.assertEquals(len(lines), 5)
+        self.assertTrue(lines[0].split()[1] == 'W')
+        self.assertTrue('ChannelBroadcastDataMessage' in lines[1])
+        self.assertTrue(lines[4].endswith('010000000000000003'))
+
+    def test_hex(self):
+        lines = self.run_main('--hex', '--direction', 'read', '--type', '0x4E')
+        self.assertEquals(len(lines), 4)
+        self.assertEquals(lines[0].split()[-1], 'A4094E000000000000000000E3')
+
+    def test_filters(self):
+        self.assertEquals(len(self.run_main('-c', '1')), 3)
+        self.assertEquals(len(self.run_main('-c', '0', '-c', '1', '-d', 'read')), 4)
+        self.assertEquals(len(self.run_main('-D', '0x1234:120')), 3)
+        self.assertEquals(len(self.run_main('-D', '0x1234:121')), 0)
+        self.assertEquals(len(self.run_main('-e', '0')), 0)
+
+    def test_device(self):
+        # the Channel ID command is a write, matched before other filters
+        self.assertEquals(len(self.run_main('-D', '0x1234', '-d', 'read')), 2)
+        self.assertEquals(len(self.run_main('-D', '0x1234', '-t', '0x4E')), 2)
+
+    def test_merge(self):
+        other = LOG_LOCATION[:-4] + '.stick.ant'
+        lw = LogWriter(other, stick=7)
+        lw.logRead(message.StartupMessage().encode())
+        lw.close()
+        lines = self.run_main(other)
+        self.assertEquals(len(lines), 6)
+        self.assertTrue(any(line.split()[2] == '7' for line in lines))
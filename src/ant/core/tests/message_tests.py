@@ -29,7 +29,8 @@ from __future__ import division, absolute_import, print_function, unicode_litera
 import unittest
 
 from ant.core.exceptions import MessageError
-from ant.core.constants import MESSAGE_SYSTEM_RESET, MESSAGE_CHANNEL_ASSIGN
+from ant.core.constants import (MESSAGE_SYSTEM_RESET, MESSAGE_CHANNEL_ASSIGN,
+                                LIB_CONFIG_CHANNEL_ID, LIB_CONFIG_RSSI)
 from ant.core.message import Message
 from ant.core import message as MSG
 
@@ -41,7 +42,7 @@ class MessageTest(unittest.TestCase):
     def test_get_payload(self):
         msg = self.message
         with self.assertRaises(MessageError):
-            msg.payload = b'\xFF' * 15
+            msg.payload = b'\xFF' * 20
         msg.payload = b'\x11' * 5
         self.assertEquals(msg.payload, b'\x11' * 5)
 
@@ -185,6 +186,40 @@ class ChannelSearchTimeoutMessageTest(unittest.TestCase):
         self.assertEquals(msg.payload, b'\x01\x02')
 
 
+class ChannelLowPrioritySearchTimeoutMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.message = MSG.ChannelLowPrioritySearchTimeoutMessage()
+
+    def test_get_setTimeout(self):
+        msg = self.message
+        msg.timeout = 0x10
+        self.assertEquals(msg.timeout, 0x10)
+
+    def test_payload(self):
+        msg = self.message
+        msg.channelNumber = 0x01
+        msg.timeout = 0x02
+        self.assertEquals(msg.payload, b'\x01\x02')
+
+
+class ChannelProximitySearchMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.message = MSG.ChannelProximitySearchMessage()
+
+    def test_get_setThreshold(self):
+        msg = self.message
+        with self.assertRaises(MessageError):
+            msg.threshold = 11
+        msg.threshold = 0x03
+        self.assertEquals(msg.threshold, 0x03)
+
+    def test_payload(self):
+        msg = self.message
+        msg.channelNumber = 0x01
+        msg.threshold = 0x02
+        self.assertEquals(msg.payload, b'\x01\x02')
+
+
 class ChannelFrequencyMessageTest(unittest.TestCase):
     def setUp(self):
         self.message = MSG.ChannelFrequencyMessage()
@@ -238,6 +273,21 @@ class NetworkKeyMessageTest(unittest.TestCase):
         self.assertEquals(msg.payload, b'\x01\x02\x03\x04\x05\x06\x07\x08\x09')
 
 
+class LibConfigMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.message = MSG.LibConfigMessage()
+
+    def test_get_config(self):
+        msg = self.message
+        msg.config = LIB_CONFIG_CHANNEL_ID | LIB_CONFIG_RSSI
+        self.assertEquals(msg.config, 0xC0)
+
+    def test_payload(self):
+        msg = self.message
+        msg.config = 0x80
+        self.assertEquals(msg.payload, b'\x00\x80')
+
+
 class TXPowerMessageTest(unittest.TestCase):
     def setUp(self):
         self.message = MSG.TXPowerMessage()
@@ -268,6 +318,11 @@ class ChannelCloseMessageTest(unittest.TestCase):
     pass
 
 
+class OpenRxScanModeMessageTest(unittest.TestCase):
+    def test_payload(self):
+        self.assertEquals(MSG.OpenRxScanModeMessage().payload, b'\x00')
+
+
 class ChannelRequestMessageTest(unittest.TestCase):
     def setUp(self):
         self.message = MSG.ChannelRequestMessage()
@@ -287,8 +342,45 @@ class ChannelRequestMessageTest(unittest.TestCase):
 
 
 class ChannelBroadcastDataMessageTest(unittest.TestCase):
-    # No currently defined methods need testing
-    pass
+    def setUp(self):
+        self.message = MSG.ChannelBroadcastDataMessage(data=b'\x01' * 8)
+
+    def test_plain(self):
+        msg = self.message
+        self.assertEquals(msg.data, b'\x01' * 8)
+        self.assertEquals(msg.flag, None)
+        self.assertEquals(msg.channelID, None)
+        self.assertEquals(msg.rssi, None)
+        self.assertEquals(msg.rxTimestamp, None)
+
+    def test_channelID(self):
+        msg = self.message
+        msg.payload += b'\x80\x34\x12\x78\x01'
+        self.assertEquals(msg.channelID, (0x1234, 120, 1))
+        self.assertEquals(msg.deviceNumber, 0x1234)
+        self.assertEquals(msg.deviceType, 120)
+        self.assertEquals(msg.transmissionType, 1)
+        self.assertEquals(msg.rssi, None)
+
+    def test_all(self):
+        msg = self.message
+        msg.payload += b'\xE0\x34\x12\x78\x01\x20\xC4\xB0\x00\x80'
+        self.assertEquals(len(msg.payload), Message.MAX_PAYLOAD)
+        self.assertEquals(msg.channelID, (0x1234, 120, 1))
+        self.assertEquals(msg.rssi, (0x20, -60, -80))
+        self.assertEquals(msg.rxTimestamp, 0x8000)
+
+    def test_skipped_fields(self):
+        msg = self.message
+        msg.payload += b'\x20\x00\x80'
+        self.assertEquals(msg.channelID, None)
+        self.assertEquals(msg.rxTimestamp, 0x8000)
+
+    def test_truncated(self):
+        msg = self.message
+        msg.payload += b'\x80\x34\x12'
+        with self.assertRaises(MessageError):
+            msg.channelID
 
 
 class ChannelAcknowledgedDataMessageTest(unittest.TestCase):
@@ -297,8 +389,25 @@ class ChannelAcknowledgedDataMessageTest(unittest.TestCase):
 
 
 class ChannelBurstDataMessageTest(unittest.TestCase):
-    # No currently defined methods need testing
-    pass
+    def setUp(self):
+        self.message = MSG.ChannelBurstDataMessage()
+
+    def test_get_sequenceNumber(self):
+        msg = self.message
+        msg.channelNumber = 0x03
+        msg.sequenceNumber = 0x05
+        self.assertEquals(msg.channelNumber, 0x03)
+        self.assertEquals(msg.sequenceNumber, 0x05)
+        with self.assertRaises(MessageError):
+            msg.sequenceNumber = 0x08
+        with self.assertRaises(MessageError):
+            msg.channelNumber = 0x20
+
+    def test_payload(self):
+        msg = self.message
+        msg.channelNumber = 0x01
+        msg.sequenceNumber = 0x06
+        self.assertEquals(msg.payload[0], 0xC1)
 
 
 class ChannelEventMessageTest(unittest.TestCase):
@@ -25,8 +25,687 @@
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
-#import unittest
+import unittest
+from threading import Lock, Thread
+from time import sleep, time
 
-#from ant.core.node import *
+from usb.core import USBError
 
-#TODO
+from ant.core import event, message
+from ant.core.exceptions import ChannelError, DriverError, NodeError
+from ant.core.constants import (EVENT_CHANNEL_CLOSED, EVENT_RX_SEARCH_TIMEOUT,
+                                MESSAGE_CHANNEL_CLOSE, MESSAGE_CHANNEL_ACKNOWLEDGED_DATA,
+                                EVENT_TRANSFER_TX_COMPLETED, EVENT_TRANSFER_TX_FAILED,
+                                TRANSFER_IN_PROGRESS, EVENT_TRANSFER_RX_FAILED,
+                                EVENT_TRANSFER_TX_START, MESSAGE_CHANNEL_BURST_DATA,
+                                EVENT_TX, CHANNEL_TYPE_TWOWAY_RECEIVE)
+from ant.core.node import (Node, Channel, Device, Network, ChannelAllocator, ScanReceiver,
+                          DeviceTracker, ChannelScheduler, BurstReceiver, Broadcaster)
+
+
+def makeNode(allocator, channels):
+    node = Node(None, allocator=allocator)
+    node.channels = [Channel(node, i) for i in range(channels)]
+    allocator.addNode(node)
+    return node
+
+
+class ChannelAllocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.allocator = ChannelAllocator()
+        self.node = makeNode(self.allocator, 4)
+
+    def test_acquire_release(self):
+        node = self.node
+        channels = [node.getFreeChannel() for _ in range(4)]
+        self.assertEquals([channel.number for channel in channels], [0, 1, 2, 3])
+        self.assertRaises(NodeError, node.getFreeChannel)
+        self.allocator.release(channels[2])
+        self.assertEquals(node.getFreeChannel(), channels[2])
+
+    def test_reserve(self):
+        self.assertTrue(self.allocator.reserve(self.node.channels[0]))
+        self.assertFalse(self.allocator.reserve(self.node.channels[0]))
+        self.assertEquals(self.node.getFreeChannel().number, 1)
+        self.assertEquals(self.allocator.available(), 2)
+
+    def test_nodes(self):
+        other = makeNode(self.allocator, 8)
+        self.assertTrue(self.allocator.acquire().node is other)
+        self.assertTrue(self.allocator.acquire(node=self.node).node is self.node)
+        self.assertEquals(self.allocator.available(other), 7)
+        self.allocator.removeNode(other)
+        self.assertEquals(self.allocator.available(), 3)
+
+    def test_affinity(self):
+        other = makeNode(self.allocator, 8)
+        first = self.allocator.acquire(affinity='shared')
+        self.assertTrue(first.node is other)
+        for _ in range(3):
+            self.allocator.acquire(node=other)
+        # still the node with the most free channels, but not the bound one
+        self.assertTrue(self.allocator.acquire(affinity='shared').node is other)
+        self.assertRaises(NodeError, self.allocator.acquire, self.node, 'shared')
+        self.assertTrue(self.allocator.acquire(affinity='other').node is self.node)
+
+    def test_threads(self):
+        node = makeNode(self.allocator, 64)
+        taken = []
+        def take():
+            for _ in range(16):
+                taken.append(self.allocator.acquire(node))
+        threads = [Thread(target=take) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(set(taken)), 64)
+
+
+class Recorder(object):
+    def __init__(self):
+        self.received = []
+
+    def process(self, msg, device):
+        self.received.append((msg.payload[1], device))
+
+
+def extended(data, number, type_, transmissionType):
+    payload = bytearray([data] * 8 + [0x80, number & 0xFF, number >> 8, type_,
+                         transmissionType])
+    return message.ChannelBroadcastDataMessage(0, payload)
+
+
+class ScanReceiverTest(unittest.TestCase):
+    def test_demux(self):
+        channel = Channel(Node(None), 0)
+        hrm, discovery = Recorder(), Recorder()
+        receiver = ScanReceiver(channel, discovery)
+        receiver.registerCallback((0x1234, 120, 1), hrm)
+
+        channel.process(extended(1, 0x1234, 120, 1))
+        channel.process(extended(2, 0x4321, 11, 5))
+        channel.process(message.ChannelBroadcastDataMessage(0, b'\x03' * 8))
+        channel.process(extended(4, 0x1234, 120, 1))
+        self.assertEquals(hrm.received, [(1, (0x1234, 120, 1)), (4, (0x1234, 120, 1))])
+        self.assertEquals(discovery.received, [(2, (0x4321, 11, 5))])
+
+        receiver.removeCallback((0x1234, 120, 1), hrm)
+        channel.process(extended(5, 0x1234, 120, 1))
+        self.assertEquals(len(hrm.received), 2)
+        self.assertEquals(len(discovery.received), 2)
+
+
+class DeviceTrackerTest(unittest.TestCase):
+    def setUp(self):
+        node = Node(None)
+        node.channels = [Channel(node, i) for i in range(2)]
+        node.channels[1].device = Device(0x4321, 11, 5)
+        self.tracker = DeviceTracker(node, timeout=10, capacity=2)
+
+    def test_process(self):
+        tracker = self.tracker
+        msg = extended(1, 0x1234, 120, 1)
+        msg.payload[9] |= 0x40
+        msg.payload += b'\x20\xC4\xB0'
+        tracker.process(msg)
+        tracker.process(message.ChannelBroadcastDataMessage(1, b'\x02' * 8))
+        tracker.process(message.ChannelBroadcastDataMessage(0, b'\x03' * 8))  # unknown
+        self.assertEquals(sorted(tracker.devices()), [(0x1234, 120, 1), (0x4321, 11, 5)])
+        state = tracker.get((0x1234, 120, 1))
+        self.assertEquals((state.count, state.rssi, state.payload), (1, -60, b'\x01' * 8))
+        self.assertEquals(tracker.get((0x4321, 11, 5)).rssi, None)
+
+    def test_rate(self):
+        tracker = self.tracker
+        for i in range(5):
+            tracker.seen((1, 2, 3), b'\x00', now=100 + i * 0.25)
+        state = tracker.get((1, 2, 3))
+        self.assertEquals((state.firstSeen, state.lastSeen, state.count), (100, 101, 5))
+        self.assertAlmostEquals(state.rate, 4)
+        self.assertEquals(state.payload, b'\x00' * 8)
+
+    def test_grow_expire(self):
+        tracker = self.tracker
+        for i in range(5):
+            tracker.seen((i, 1, 1), b'', now=100 + i)
+        self.assertEquals(len(tracker), 5)
+        self.assertEquals(sorted(tracker.expire(now=112)), [(0, 1, 1), (1, 1, 1)])
+        self.assertFalse((0, 1, 1) in tracker)
+        tracker.seen((9, 1, 1), b'', now=112)  # reuses a freed slot
+        self.assertEquals(len(tracker._keys), 8)
+        self.assertEquals(len(tracker), 4)
+
+
+class FakeChannel(Channel):
+    def __init__(self, number):
+        super(FakeChannel, self).__init__(None, number)
+        self.commands = []
+        self._searchTimeout = None
+
+    searchTimeout = property(lambda self: self._searchTimeout)
+    @searchTimeout.setter
+    def searchTimeout(self, timeout):
+        self._searchTimeout = timeout
+
+    def setID(self, devType, devNum, transType):
+        self.device = Device(devNum, devType, transType)
+
+    def open(self):
+        self.commands.append(('open', self.device.number))
+
+    def close(self):
+        self.commands.append(('close', self.device.number))
+
+    def receive(self):
+        self.process(message.ChannelBroadcastDataMessage(self.number))
+
+    def event(self, code):
+        self.process(message.ChannelEventResponseMessage(self.number, 1, code))
+
+
+class ChannelSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.channels = [FakeChannel(0), FakeChannel(1)]
+        self.scheduler = ChannelScheduler(self.channels, dwell=1)
+        for number, priority in ((1, 1), (2, 1), (3, 10)):
+            self.scheduler.addDevice((number, 120, 1), priority)
+
+    def owners(self):
+        return [channel.device.number for channel in self.channels]
+
+    def test_rotation(self):
+        scheduler, channels = self.scheduler, self.channels
+        scheduler.step(now=scheduler._targets[(1, 120, 1)].added + 1)
+        self.assertTrue(3 in self.owners())  # highest priority first
+        self.assertEquals(channels[0].searchTimeout, scheduler.searchTimeout)
+
+        # channel 0 finds its device, channel 1 times out
+        channels[0].receive()
+        channels[1].event(EVENT_RX_SEARCH_TIMEOUT)
+        channels[1].event(EVENT_CHANNEL_CLOSED)
+        waiting = set([1, 2]) - set(self.owners())
+        scheduler.step()
+        self.assertEquals(channels[1].device.number, waiting.pop())
+        self.assertFalse(any(command == 'close' for command, _ in channels[1].commands))
+
+        # once the dwell time is over channel 0 moves on
+        first = channels[0].device.number
+        scheduler.step(now=time() + 2)
+        self.assertTrue(('close', first) in channels[0].commands)
+        self.assertNotEquals(channels[0].device.number, first)
+
+    def test_coverage(self):
+        scheduler = self.scheduler
+        scheduler.step()
+        for channel in self.channels:
+            channel.receive()
+        coverage = scheduler.coverage(now=time() + 1)
+        tracked = [key for key, metrics in coverage.items() if metrics.found]
+        self.assertEquals(len(tracked), 2)
+        for key in tracked:
+            self.assertEquals((coverage[key].turns, coverage[key].messages), (1, 1))
+            self.assertTrue(coverage[key].coverage > 0)
+        self.assertTrue(all(metrics.coverage == 0 for key, metrics in coverage.items()
+                            if key not in tracked))
+
+    def test_stale_state(self):
+        # a new owner not heard yet, the channel still TRACKING from the last
+        scheduler, channel = self.scheduler, self.channels[0]
+        scheduler.step()
+        owner = channel.device.number
+        scheduler._states[channel] = scheduler.TRACKING
+        scheduler.step(now=time() + 2)
+        self.assertEquals(channel.device.number, owner)
+
+    def test_handover(self):
+        # the last owner is still heard while its channel is being closed
+        scheduler, channel = self.scheduler, self.channels[0]
+        scheduler.step()
+        scheduler.removeDevice(channel.device)
+        close = channel.close
+        def closing():
+            channel.receive()
+            close()
+        channel.close = closing
+        scheduler.step()
+        metrics = scheduler.coverage()[scheduler._key(channel.device)]
+        self.assertEquals((metrics.found, metrics.messages), (0, 0))
+        channel.receive()
+        self.assertEquals(scheduler.coverage()[scheduler._key(channel.device)].messages, 1)
+
+    def test_run_errors(self):
+        def fail():
+            raise RuntimeError('unplugged')
+        self.channels[0].open = fail
+        scheduler = self.scheduler
+        scheduler.interval = 0.01
+        scheduler.start()
+        sleep(0.05)
+        self.assertTrue(scheduler._thread.is_alive())
+        scheduler.stop()
+
+
+class StickDriver(object):
+    # answers channel commands through the event machine's callbacks, before
+    # write() returns
+    def __init__(self):
+        self.evm = None
+
+    def write(self, msg):
+        if isinstance(msg, event.MessageBatch):
+            self.deliver(self.burst(msg.messages))
+            return
+        responses = [message.ChannelEventResponseMessage(msg.channelNumber, msg.type, 0)]
+        if msg.type == MESSAGE_CHANNEL_ACKNOWLEDGED_DATA:
+            responses = self.acknowledged(msg)
+        elif msg.type == MESSAGE_CHANNEL_CLOSE:
+            responses.append(message.ChannelEventResponseMessage(
+                msg.channelNumber, 1, EVENT_CHANNEL_CLOSED))
+        self.deliver(responses)
+
+    def deliver(self, responses):
+        # from another thread, like the event pump
+        def pump():
+            for response in responses:
+                for callback in list(self.evm.callbacks):
+                    callback.process(response)
+        thread = Thread(target=pump)
+        thread.start()
+        thread.join()
+
+    def acknowledged(self, msg):
+        return [message.ChannelEventResponseMessage(msg.channelNumber, 1,
+                                                    EVENT_TRANSFER_TX_COMPLETED)]
+
+    def burst(self, packets):
+        channel, responses = packets[0].channelNumber, []
+        if packets[0].sequenceNumber == 0:
+            responses.append(message.ChannelEventResponseMessage(
+                channel, 1, EVENT_TRANSFER_TX_START))
+        if packets[-1].sequenceNumber & message.ChannelBurstDataMessage.LAST_PACKET:
+            responses.append(message.ChannelEventResponseMessage(
+                channel, 1, EVENT_TRANSFER_TX_COMPLETED))
+        return responses
+
+
+class CloseTest(unittest.TestCase):
+    def setUp(self):
+        driver = StickDriver()
+        self.node = node = Node(driver)
+        driver.evm = node.evm
+        node.channels = [Channel(node, i) for i in range(4)]
+        for channel in node.channels:
+            channel.open()
+
+    def test_close(self):
+        channel = self.node.channels[1]
+        channel.close()
+        self.assertFalse(channel.opened)
+        self.assertFalse(channel in self.node.evm.callbacks)
+
+    def test_closeAll(self):
+        self.node.channels[2].close()
+        self.node.closeAll()
+        self.assertFalse(any(channel.opened for channel in self.node.channels))
+        self.assertEquals(self.node.evm.events.waiters, {})
+
+
+class LossyDriver(StickDriver):
+    # fails each channel's first two acknowledged transfers, one of them with
+    # a response error
+    def __init__(self):
+        super(LossyDriver, self).__init__()
+        self.sent = []
+
+    def acknowledged(self, msg):
+        channel = msg.channelNumber
+        self.sent.append((channel, msg.payload[1]))
+        attempts = len([sent for sent in self.sent if sent[0] == channel])
+        if attempts == 1:
+            return [message.ChannelEventResponseMessage(channel, msg.type,
+                                                        TRANSFER_IN_PROGRESS)]
+        if attempts == 2:
+            return [message.ChannelEventResponseMessage(channel, 1,
+                                                        EVENT_TRANSFER_TX_FAILED)]
+        return super(LossyDriver, self).acknowledged(msg)
+
+
+class AcknowledgedTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = driver = LossyDriver()
+        self.node = node = Node(driver)
+        driver.evm = node.evm
+        node.channels = [Channel(node, i) for i in range(2)]
+        for channel in node.channels:
+            channel.open()
+
+    def test_retry(self):
+        channels = self.node.channels
+        futures = [channels[0].sendAcknowledged(b'\x01' * 8),
+                   channels[0].sendAcknowledged(b'\x02' * 8),
+                   channels[1].sendAcknowledged(b'\x03' * 8)]
+        self.assertEquals([future.result(timeout=5) for future in futures], [3, 1, 3])
+        self.assertEquals([data for channel, data in self.driver.sent if channel == 0],
+                          [1, 1, 1, 2])
+
+    def test_failure(self):
+        future = self.node.channels[0].sendAcknowledged(b'\x01' * 8, retries=1)
+        self.assertTrue(isinstance(future.exception(timeout=5), ChannelError))
+        self.assertRaises(ChannelError, future.result)
+
+    def test_closed(self):
+        channel = self.node.channels[1]
+        channel.device = Device(0x1234, 120, 1)
+        self.assertEquals(str(channel), '<channel 1 (0x1234)>')
+        self.driver.acknowledged = lambda msg: []  # never completes
+        future = channel.sendAcknowledged(b'\x01' * 8)
+        channel.close()
+        self.assertTrue(isinstance(future.exception(timeout=5), ChannelError))
+
+    def test_timeout(self):
+        channel = self.node.channels[1]
+        channel.transfers.timeout = 0.05
+        lost = [True]
+        def acknowledged(msg):
+            if lost:
+                del lost[:]
+                return []  # the event never comes
+            return StickDriver.acknowledged(self.driver, msg)
+        self.driver.acknowledged = acknowledged
+        futures = [channel.sendAcknowledged(b'\x01' * 8),
+                   channel.sendAcknowledged(b'\x02' * 8)]
+        self.assertTrue(isinstance(futures[0].exception(timeout=5), ChannelError))
+        self.assertEquals(futures[1].result(timeout=5), 1)
+
+
+class BurstRecorder(object):
+    def __init__(self):
+        self.transfers = []
+
+    def process(self, data, channel):
+        self.transfers.append((bytes(bytearray(data)), channel.number))
+
+
+def burst(channel, data, first=0):
+    # packets for `data`, a multiple of 8 bytes long
+    packets, counter = [], first
+    for offset in range(0, len(data), 8):
+        sequence = counter
+        if offset + 8 >= len(data):
+            sequence |= message.ChannelBurstDataMessage.LAST_PACKET
+        packets.append(message.ChannelBurstDataMessage(channel, data[offset:offset + 8],
+                                                       sequence))
+        counter = counter % 3 + 1
+    return packets
+
+
+class BurstReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.channel = Channel(Node(None), 2)
+        self.recorder = BurstRecorder()
+        self.receiver = BurstReceiver(self.channel, self.recorder, size=16)
+
+    def receive(self, packets):
+        for packet in packets:
+            self.channel.process(packet)
+
+    def test_reassembly(self):
+        data = bytearray(range(64))
+        self.receive(burst(2, data))
+        self.receive(burst(2, data[:8]))
+        self.assertEquals(self.recorder.transfers, [(bytes(data), 2), (bytes(data[:8]), 2)])
+        self.assertEquals((self.receiver.transfers, self.receiver.failures), (2, 0))
+
+    def test_failures(self):
+        data = bytearray(range(40))
+        packets = burst(2, data)
+        self.receive(packets[:2] + packets[3:])  # gap
+        self.receive(packets[:3])
+        self.channel.process(message.ChannelEventResponseMessage(2, 1, EVENT_TRANSFER_RX_FAILED))
+        self.receive(packets[:2] + packets)  # restarted
+        self.assertEquals(self.recorder.transfers, [(bytes(data), 2)])
+        self.assertEquals(self.receiver.failures, 3)
+
+    def test_memoryview(self):
+        self.receiver.copy = False
+        self.receive(burst(2, bytearray(range(32))))
+        self.receive(burst(2, bytearray(range(64))))
+        self.assertEquals([len(data) for data, _ in self.recorder.transfers], [32, 64])
+
+
+class BurstDriver(StickDriver):
+    # records the packets written, answering the first block with
+    # TRANSFER_IN_PROGRESS
+    def __init__(self):
+        super(BurstDriver, self).__init__()
+        self.packets = []
+        self.busy = 1
+
+    def burst(self, packets):
+        self.packets.extend(packets)
+        if self.busy:
+            self.busy -= 1
+            return [message.ChannelEventResponseMessage(
+                packets[0].channelNumber, MESSAGE_CHANNEL_BURST_DATA, TRANSFER_IN_PROGRESS)]
+        return super(BurstDriver, self).burst(packets)
+
+
+class BurstSendTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = driver = BurstDriver()
+        self.node = node = Node(driver)
+        driver.evm = node.evm
+        self.channel = channel = Channel(node, 1)
+        channel.open()
+
+    def test_send(self):
+        self.driver.busy = 0
+        data = bytearray(range(100))
+        future = self.channel.sendBurst(data)
+        self.assertEquals(future.result(timeout=5), 1)
+        self.assertEquals((future.sent, future.total, future.progress), (13, 13, 1.0))
+        packets = self.driver.packets
+        self.assertEquals([packet.sequenceNumber for packet in packets],
+                          [packet.sequenceNumber for packet in burst(1, data + bytearray(4))])
+        self.assertEquals(bytearray().join(packet.data for packet in packets),
+                          data + bytearray(4))
+
+    def test_retry(self):
+        data = bytearray(range(24))
+        futures = [self.channel.sendBurst(data), self.channel.sendAcknowledged(b'\x01' * 8)]
+        self.assertEquals([future.result(timeout=5) for future in futures], [2, 1])
+        self.assertEquals(len(self.driver.packets), 6)
+
+    def test_empty(self):
+        self.assertRaises(ChannelError, self.channel.sendBurst, b'')
+        self.assertEquals(self.driver.packets, [])
+
+
+class FrameDriver(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, msg):
+        self.written.append(message.Message.decode(msg.encode()))
+
+
+class BroadcasterTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = FrameDriver()
+        self.channel = Channel(Node(self.driver), 3)
+
+    def tick(self, count):
+        for _ in range(count):
+            self.channel.process(message.ChannelEventResponseMessage(3, 1, EVENT_TX))
+
+    def test_pages(self):
+        pages = [bytearray([page] * 8) for page in range(3)]
+        broadcaster = Broadcaster(self.channel, pages=pages)
+        self.tick(1)  # not started
+        broadcaster.start()
+        self.tick(4)
+        broadcaster.stop()
+        self.tick(1)
+        written = self.driver.written
+        self.assertEquals([msg.payload[1] for msg in written], [0, 1, 2, 0, 1])
+        self.assertTrue(all(msg.type == message.ChannelBroadcastDataMessage.type
+                            and msg.payload[0] == 3 for msg in written))
+        self.assertEquals(broadcaster.sent, 5)
+
+    def test_provider(self):
+        counter = [0]
+        def provider(channel):
+            counter[0] += 1
+            if counter[0] == 3:
+                return None  # the stick sends the last payload again
+            return bytearray(range(counter[0], counter[0] + 8))
+        broadcaster = Broadcaster(self.channel, provider=provider)
+        broadcaster.start()
+        self.tick(3)
+        self.assertEquals([bytes(msg.payload[1:]) for msg in self.driver.written],
+                          [bytes(bytearray(range(i, i + 8))) for i in (1, 2, 4)])
+        self.assertEquals(broadcaster.sent, 3)
+
+    def test_invalid(self):
+        self.assertRaises(ChannelError, Broadcaster, self.channel)
+        self.assertRaises(ChannelError, Broadcaster, self.channel, pages=[])
+
+
+class UnpluggedDriver(object):
+    # a stick answering through read(), as the pump expects, that is
+    # unplugged once `unplug` is set and back after `failures` reopens
+    def __init__(self, failures=2):
+        self.lock = Lock()
+        self.buffer = b''
+        self.written = []
+        self.opened = False
+        self.unplug = False
+        self.failures = failures
+        self.broken = False  # writes fail
+
+    def open(self):
+        self.opened = True
+
+    def close(self):
+        self.opened = False
+
+    def reopen(self):
+        if self.failures:
+            self.failures -= 1
+            raise USBError('no device', errno=19)
+        self.unplug = False
+        self.opened = True
+
+    def read(self, count):
+        if self.unplug:
+            raise USBError('no device', errno=19)
+        with self.lock:
+            data, self.buffer = self.buffer[:count], self.buffer[count:]
+        if not data:
+            sleep(0.001)
+            raise USBError('timeout', errno=110)
+        return bytes(data)
+
+    def write(self, msg):
+        if self.broken:
+            raise DriverError('Could not write to device (broken).')
+        responses = []
+        for written in getattr(msg, 'messages', (msg,)):
+            self.written.append(written)
+            if isinstance(written, message.SystemResetMessage):
+                responses.append(message.StartupMessage())
+            else:
+                channel = written.payload[0] if isinstance(written, message.ChannelMessage) \
+                          else 0
+                responses.append(message.ChannelEventResponseMessage(channel, written.type, 0))
+        with self.lock:
+            for response in responses:
+                self.buffer += bytes(response.encode())
+
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = driver = UnpluggedDriver()
+        self.node = node = Node(driver)
+        self.events = []
+        node.registerEventListener(self)
+        node.evm.start()
+        node.networks = [None, None]
+        node.channels = [Channel(node, i) for i in range(3)]
+        self.recovery = node.enableRecovery(backoff=0.001)
+
+    def tearDown(self):
+        self.node.evm.stop()
+
+    def process(self, msg):
+        if isinstance(msg, event.ConnectionEvent):
+            self.events.append(msg)
+
+    def test_replay(self):
+        node = self.node
+        node.setNetworkKey(1, Network(b'\x01' * 8))
+        channel = node.channels[2]
+        channel.assign(node.networks[1], CHANNEL_TYPE_TWOWAY_RECEIVE)
+        channel.setID(120, 0, 0)
+        channel.period = 8070
+        channel.open()
+        del self.driver.written[:]
+
+        self.driver.unplug = True
+        basetime = time()
+        while len(self.events) < 2 and time() - basetime < 5:
+            sleep(0.001)
+        self.assertEquals([e.state for e in self.events],
+                          [event.ConnectionEvent.LOST, event.ConnectionEvent.RECOVERED])
+        self.assertTrue(self.events[1].elapsed < 1)
+        self.assertEquals(self.recovery.recoveries, 1)
+        self.assertEquals([msg.type for msg in self.driver.written],
+                          [message.SystemResetMessage.type, message.NetworkKeyMessage.type,
+                           message.ChannelAssignMessage.type, message.ChannelIDMessage.type,
+                           message.ChannelPeriodMessage.type, message.ChannelOpenMessage.type])
+        self.assertTrue(node.running)
+
+    def wait(self, count):
+        basetime = time()
+        while len(self.events) < count and time() - basetime < 5:
+            sleep(0.001)
+        return [e.state for e in self.events]
+
+    def test_transfers(self):
+        node = self.node
+        node.setNetworkKey(0, Network())
+        channel = node.channels[0]
+        channel.assign(node.networks[0], CHANNEL_TYPE_TWOWAY_RECEIVE)
+        channel.open()
+        channel.transfers.timeout = 60
+        future = channel.sendAcknowledged(b'\x01' * 8)  # never completes
+        self.driver.unplug = True
+        self.assertTrue(isinstance(future.exception(timeout=5), ChannelError))
+        self.assertEquals(self.wait(2)[-1], event.ConnectionEvent.RECOVERED)
+
+    def test_replay_scan_mode(self):
+        node = self.node
+        node.setNetworkKey(0, Network())
+        channel = node.channels[0]
+        channel.assign(node.networks[0], CHANNEL_TYPE_TWOWAY_RECEIVE)
+        channel.openRxScanMode()
+        del self.driver.written[:]
+
+        self.driver.unplug = True
+        self.assertEquals(self.wait(2)[-1], event.ConnectionEvent.RECOVERED)
+        self.assertEquals(self.driver.written[-1].type, message.OpenRxScanModeMessage.type)
+
+    def test_replay_error(self):
+        self.driver.broken = True
+        self.driver.unplug = True
+        self.assertEquals(self.wait(2),
+                          [event.ConnectionEvent.LOST, event.ConnectionEvent.FAILED])
+        self.assertTrue(isinstance(self.events[1].error, DriverError))
+
+    def test_failed(self):
+        self.recovery.retries = 1
+        self.driver.unplug = True
+        self.node.evm.eventPump.join(5)
+        self.assertEquals([e.state for e in self.events],
+                          [event.ConnectionEvent.LOST, event.ConnectionEvent.FAILED])